@@ -0,0 +1,113 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class AnswerCache:
+    """LRU cache of LLM answers.
+
+    Exact hits are keyed on the hash of the final prompt. When similarity_threshold is set, a miss
+    falls back to near-duplicate lookup: a cached answer is reused if it was produced for the same
+    set of retrieved patent ids and its query embedding has cosine similarity >= the threshold.
+    """
+
+    def __init__(self, max_size=512, ttl=3600, similarity_threshold=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._by_ids = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def prompt_key(prompt):
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        keys = self._by_ids.get(entry["ids"])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_ids[entry["ids"]]
+
+    def get(self, prompt, query_vec=None, ids=()):
+        key = self.prompt_key(prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry["created"]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry["answer"]
+                self._remove(key)
+
+            if self.similarity_threshold is not None and query_vec is not None:
+                query_vec = self._unit(query_vec)
+                best_key, best_score = None, self.similarity_threshold
+                for candidate in list(self._by_ids.get(frozenset(ids), ())):
+                    entry = self._entries[candidate]
+                    if self._expired(entry["created"]):
+                        self._remove(candidate)
+                        continue
+                    if entry["query_vec"] is None:
+                        continue
+                    score = float(np.dot(query_vec, entry["query_vec"]))
+                    if score >= best_score:
+                        best_key, best_score = candidate, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    return self._entries[best_key]["answer"]
+
+            self.misses += 1
+            return None
+
+    def put(self, prompt, answer, query_vec=None, ids=()):
+        key = self.prompt_key(prompt)
+        ids = frozenset(ids)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "created": time.time(),
+                "ids": ids,
+                "query_vec": self._unit(query_vec) if query_vec is not None else None,
+                "answer": answer,
+            }
+            self._by_ids.setdefault(ids, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self):
+        """Drops every answer, e.g. after the index was rebuilt."""
+        with self._lock:
+            self._entries.clear()
+            self._by_ids.clear()
+
+    def stats(self):
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+        }
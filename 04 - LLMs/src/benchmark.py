@@ -1,13 +1,40 @@
 import json
 import os
+import time
+import faiss
+import numpy as np
 from pathlib import Path
 from typing import Dict, List, Tuple
 from dotenv import load_dotenv
 from tqdm import tqdm
 from patent_rag_system import PatentRAGSystem
+from faiss_index import FAISSIndex
+from rag import BGE_MODEL_NAME, BGE_QUERY_INSTRUCTION, RetrievalResult
+from reranker import DEFAULT_RERANK_MODEL, Reranker
+from vectorizer import Vectorizer
 
 load_dotenv()
 
+RUN_INDEX_BENCHMARK = True
+INDEX_CONFIGS = [
+    {"index_spec": "Flat"},
+    {"index_spec": "IVF1024,Flat", "nprobe": 8},
+    {"index_spec": "IVF1024,Flat", "nprobe": 32},
+    {"index_spec": "IVF1024,PQ64", "nprobe": 16},
+    {"index_spec": "OPQ64,IVF1024,PQ64", "nprobe": 16},
+    {"index_spec": "HNSW32", "ef_search": 64},
+    {"index_spec": "HNSW32", "ef_search": 256},
+]
+RUN_RETRIEVAL_MODE_BENCHMARK = True
+RETRIEVAL_MODES = ["dense", "sparse", "hybrid"]
+RUN_RERANK_BENCHMARK = True
+RERANK_CANDIDATES = 20
+RUN_STORAGE_BENCHMARK = True
+STORAGES = ["float32", "float16", "int8", "binary"]
+RUN_ENCODER_BENCHMARK = True
+ENCODER_BACKENDS = ["torch", "onnx", "onnx-int8"]
+ENCODER_SAMPLE_SIZE = 512
+
 
 class BenchmarkSystem:
 
@@ -39,30 +66,43 @@ class BenchmarkSystem:
         
         return queries
     
-    def evaluate_model(self, model_name, top_k=5):
+    def evaluate_model(self, model_name, top_k=5, batch_size=64, rag_system=None):
         print(f"\n{'='*60}")
         print(f"Evaluating model: {model_name}")
         print(f"{'='*60}")
         
         # Initialize RAG system with the specified model
-        rag_system = PatentRAGSystem(
-            dataset_path=self.dataset_path,
-            model_name=model_name,
-            dataset_tag=self.dataset_tag,
-            score_threshold=0.1
-        )
+        if rag_system is None:
+            rag_system = PatentRAGSystem(
+                dataset_path=self.dataset_path,
+                model_name=model_name,
+                dataset_tag=self.dataset_tag,
+                score_threshold=0.1
+            )
         
         results = []
         
-        # Iterate through all queries with progress bar
-        for query_item in tqdm(self.queries, desc=f"Processing queries", leave=True):
-            query_text = query_item["query"]
-            ground_truth = query_item["ground_truth_file"]
-            cpc_code = query_item["cpc_code"]
+        # Encode and search the queries in batches instead of one by one
+        for start in tqdm(range(0, len(self.queries), batch_size), desc=f"Processing query batches", leave=True):
+            batch = self.queries[start:start + batch_size]
             
             try:
-                # Retrieve top-k documents
-                _, retrieved_files, scores = rag_system.query(query_text, top_k=top_k)
+                t0 = time.perf_counter()
+                batch_results = rag_system.retrieve_batch([q["query"] for q in batch], top_k=top_k)
+                latency_ms = (time.perf_counter() - t0) * 1000 / len(batch)
+                batch_error = None
+            except Exception as e:
+                print(f"\nError processing query batch starting at {start}: {e}")
+                batch_results = [RetrievalResult(query=q["query"]) for q in batch]
+                latency_ms = None
+                batch_error = str(e)
+            
+            for query_item, retrieval in zip(batch, batch_results):
+                retrieved_files = retrieval.files
+                scores = retrieval.scores
+                query_text = query_item["query"]
+                ground_truth = query_item["ground_truth_file"]
+                cpc_code = query_item["cpc_code"]
                 
                 # Check hits at different K values
                 hit_at_1 = ground_truth in retrieved_files[:1] if len(retrieved_files) >= 1 else False
@@ -75,7 +115,7 @@ class BenchmarkSystem:
                     rank = retrieved_files.index(ground_truth) + 1  # 1-indexed
                     reciprocal_rank = 1.0 / rank
                 
-                results.append({
+                result = {
                     "cpc_code": cpc_code,
                     "query": query_text,
                     "ground_truth_file": ground_truth,
@@ -84,26 +124,205 @@ class BenchmarkSystem:
                     "hit_at_1": hit_at_1,
                     "hit_at_3": hit_at_3,
                     "hit_at_5": hit_at_5,
-                    "reciprocal_rank": reciprocal_rank
-                })
-                
-            except Exception as e:
-                print(f"\nError processing query '{query_text[:50]}...': {e}")
-                results.append({
-                    "cpc_code": cpc_code,
-                    "query": query_text,
-                    "ground_truth_file": ground_truth,
-                    "retrieved_files": [],
-                    "scores": [],
-                    "hit_at_1": False,
-                    "hit_at_3": False,
-                    "hit_at_5": False,
-                    "reciprocal_rank": 0.0,
-                    "error": str(e)
-                })
+                    "reciprocal_rank": reciprocal_rank,
+                    "latency_ms": latency_ms
+                }
+                if batch_error:
+                    result["error"] = batch_error
+                results.append(result)
         
         return results
     
+    def evaluate_index_configs(self, model_name, index_configs, top_k=5):
+        """Compares ANN index configs against the exact flat index: recall@k, p50/p95 latency and index size."""
+        print(f"\n{'='*60}")
+        print(f"Evaluating index configs for model: {model_name}")
+        print(f"{'='*60}")
+
+        rag_system = PatentRAGSystem(
+            dataset_path=self.dataset_path,
+            model_name=model_name,
+            dataset_tag=self.dataset_tag,
+            score_threshold=0.1
+        )
+
+        prefix = BGE_QUERY_INSTRUCTION if model_name == BGE_MODEL_NAME else ""
+        query_vecs = rag_system.vectorizer.encode_texts([prefix + q["query"] for q in self.queries])
+        faiss.normalize_L2(query_vecs)
+
+        exact = rag_system.faiss_index.index
+        _, exact_ids = exact.search(query_vecs, top_k)
+
+        results = []
+        for config in index_configs:
+            spec = config["index_spec"]
+            build_start = time.perf_counter()
+            faiss_index = FAISSIndex(
+                rag_system.vectors, rag_system.docs,
+                index_spec=spec, nprobe=config.get("nprobe"), ef_search=config.get("ef_search")
+            )
+            build_time = time.perf_counter() - build_start
+
+            latencies = []
+            recalls = []
+            for q, query_vec in enumerate(query_vecs):
+                start = time.perf_counter()
+                _, ids = faiss_index.index.search(query_vec.reshape(1, -1), top_k)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+                expected = set(exact_ids[q][exact_ids[q] != -1].tolist())
+                if expected:
+                    recalls.append(len(expected & set(ids[0].tolist())) / len(expected))
+
+            results.append({
+                **config,
+                "recall_at_k": float(np.mean(recalls)) if recalls else 0.0,
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                "index_mb": faiss.serialize_index(faiss_index.index).nbytes / 2**20,
+                "build_s": build_time,
+            })
+
+        print(f"\n{'Index':<28} {'Recall@' + str(top_k):<10} {'p50 ms':<10} {'p95 ms':<10} {'Size MB':<10} {'Build s':<10}")
+        print(f"{'-'*78}")
+        for r in results:
+            knobs = ",".join(f"{k}={r[k]}" for k in ("nprobe", "ef_search") if r.get(k) is not None)
+            label = f"{r['index_spec']} {knobs}".strip()
+            print(f"{label:<28} {r['recall_at_k']:<10.4f} {r['p50_ms']:<10.3f} {r['p95_ms']:<10.3f} "
+                  f"{r['index_mb']:<10.1f} {r['build_s']:<10.1f}")
+
+        return results
+
+    def evaluate_retrieval_modes(self, model_name, modes, top_k=5):
+        """Runs the query set through dense, BM25 and hybrid retrieval on one system: hit@k, MRR and latency."""
+        rag_system = PatentRAGSystem(
+            dataset_path=self.dataset_path,
+            model_name=model_name,
+            dataset_tag=self.dataset_tag,
+            score_threshold=0.1
+        )
+
+        results = {}
+        for mode in modes:
+            rag_system.set_retrieval_mode(mode)
+            results[mode] = self.calculate_metrics(
+                self.evaluate_model(f"{model_name} ({mode})", top_k=top_k, rag_system=rag_system)
+            )
+
+        print(f"\n{'Mode':<10} {'Hit@1':<10} {'Hit@3':<10} {'Hit@5':<10} {'MRR':<10} {'ms/query':<10}")
+        print(f"{'-'*60}")
+        for mode, m in results.items():
+            print(f"{mode:<10} {m['hit_rate_at_1']:<10.4f} {m['hit_rate_at_3']:<10.4f} {m['hit_rate_at_5']:<10.4f} "
+                  f"{m['mrr']:<10.4f} {m['avg_latency_ms']:<10.2f}")
+
+        return results
+
+    def evaluate_reranker(self, model_name, rerank_model=DEFAULT_RERANK_MODEL, candidates=20, top_k=5):
+        """Bi-encoder alone vs bi-encoder + cross-encoder over the top candidates: quality gain and added latency."""
+        rag_system = PatentRAGSystem(
+            dataset_path=self.dataset_path,
+            model_name=model_name,
+            dataset_tag=self.dataset_tag,
+            score_threshold=0.1
+        )
+
+        base = self.calculate_metrics(self.evaluate_model(model_name, top_k=top_k, rag_system=rag_system))
+        reranker = Reranker(rerank_model, candidates=candidates)
+        reranker.warm_up()
+        rag_system.set_reranker(reranker)
+        reranked = self.calculate_metrics(
+            self.evaluate_model(f"{model_name} + {rerank_model}", top_k=top_k, rag_system=rag_system)
+        )
+        rag_system.set_reranker(None)
+
+        print(f"\n{'Metric':<16} {'Bi-encoder':<12} {'Reranked':<12} {'Delta':<12}")
+        print(f"{'-'*52}")
+        for key, label in [("hit_rate_at_1", "Hit Rate @ 1"), ("hit_rate_at_3", "Hit Rate @ 3"),
+                           ("hit_rate_at_5", "Hit Rate @ 5"), ("mrr", "MRR"), ("avg_latency_ms", "ms/query")]:
+            print(f"{label:<16} {base[key]:<12.4f} {reranked[key]:<12.4f} {reranked[key] - base[key]:<+12.4f}")
+
+        return {
+            "rerank_model": rerank_model,
+            "candidates": candidates,
+            "bi_encoder": base,
+            "reranked": reranked,
+            "mrr_gain": reranked["mrr"] - base["mrr"],
+            "added_latency_ms": reranked["avg_latency_ms"] - base["avg_latency_ms"],
+            "reranker_stats": reranker.stats(),
+        }
+
+    def evaluate_storages(self, model_name, storages, top_k=5, rescore_factor=4):
+        """Flat index over float32 vs compact codes rescored from full precision: memory, latency and hit@k/MRR delta."""
+        rag_system = PatentRAGSystem(
+            dataset_path=self.dataset_path,
+            model_name=model_name,
+            dataset_tag=self.dataset_tag,
+            score_threshold=0.1
+        )
+
+        results = {}
+        for storage in storages:
+            rag_system.faiss_index = FAISSIndex(
+                rag_system.vectors, rag_system.docs, storage=storage, rescore_factor=rescore_factor
+            )
+            rag_system.set_retrieval_mode("dense")
+            index = rag_system.faiss_index.index
+            serialized = faiss.serialize_index_binary(index) if storage == "binary" else faiss.serialize_index(index)
+            results[storage] = {
+                **self.calculate_metrics(
+                    self.evaluate_model(f"{model_name} ({storage})", top_k=top_k, rag_system=rag_system)
+                ),
+                "index_mb": serialized.nbytes / 2**20,
+            }
+
+        baseline = results.get("float32")
+        print(f"\n{'Storage':<10} {'Index MB':<10} {'ms/query':<10} {'Hit@5':<10} {'MRR':<10} {'MRR delta':<10}")
+        print(f"{'-'*60}")
+        for storage, m in results.items():
+            m["mrr_delta"] = m["mrr"] - baseline["mrr"] if baseline else 0.0
+            print(f"{storage:<10} {m['index_mb']:<10.1f} {m['avg_latency_ms']:<10.2f} "
+                  f"{m['hit_rate_at_5']:<10.4f} {m['mrr']:<10.4f} {m['mrr_delta']:<+10.4f}")
+
+        return results
+
+    def evaluate_encoder_backends(self, model_name, backends, sample_size=512, batch_size=64, threads=None):
+        """CPU encode throughput of each encoder backend on corpus texts, and cosine agreement with PyTorch."""
+        rag_system = PatentRAGSystem(
+            dataset_path=self.dataset_path,
+            model_name=model_name,
+            dataset_tag=self.dataset_tag,
+            score_threshold=0.1
+        )
+        texts = [doc["text"] for doc in rag_system.docs[:sample_size]]
+
+        results = {}
+        reference = None
+        for backend in backends:
+            vectorizer = Vectorizer(model_name=model_name, device="cpu", backend=backend, threads=threads)
+            vectorizer.warm_up()
+            start = time.perf_counter()
+            vectors = vectorizer.encode_texts(texts, batch_size=batch_size, show_progress_bar=False)
+            elapsed = time.perf_counter() - start
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            if reference is None:
+                reference = vectors
+            cosines = np.sum(vectors * reference, axis=1)
+            results[backend] = {
+                "texts_per_s": len(texts) / elapsed,
+                "min_cosine": float(cosines.min()),
+                "mean_cosine": float(cosines.mean()),
+            }
+
+        base = results[backends[0]]["texts_per_s"]
+        print(f"\n{'Backend':<12} {'texts/s':<10} {'Speedup':<10} {'Min cos':<10} {'Mean cos':<10}")
+        print(f"{'-'*52}")
+        for backend, r in results.items():
+            r["speedup"] = r["texts_per_s"] / base
+            print(f"{backend:<12} {r['texts_per_s']:<10.1f} {r['speedup']:<10.2f} "
+                  f"{r['min_cosine']:<10.4f} {r['mean_cosine']:<10.4f}")
+
+        return results
+
     def calculate_metrics(self, results):
         
         total_queries = len(results)
@@ -114,6 +333,7 @@ class BenchmarkSystem:
                 "hit_rate_at_3": 0.0,
                 "hit_rate_at_5": 0.0,
                 "mrr": 0.0,
+                "avg_latency_ms": 0.0,
                 "total_queries": 0
             }
         
@@ -122,12 +342,14 @@ class BenchmarkSystem:
         hit_count_at_5 = sum(1 for r in results if r["hit_at_5"])
         
         total_reciprocal_rank = sum(r["reciprocal_rank"] for r in results)
+        latencies = [r["latency_ms"] for r in results if r.get("latency_ms") is not None]
         
         return {
             "hit_rate_at_1": hit_count_at_1 / total_queries,
             "hit_rate_at_3": hit_count_at_3 / total_queries,
             "hit_rate_at_5": hit_count_at_5 / total_queries,
             "mrr": total_reciprocal_rank / total_queries,
+            "avg_latency_ms": float(np.mean(latencies)) if latencies else 0.0,
             "total_queries": total_queries
         }
     
@@ -197,6 +419,23 @@ def main():
         }
     }
     
+    if RUN_INDEX_BENCHMARK:
+        full_results["index_configs"] = benchmark.evaluate_index_configs(MODEL_BGE_LARGE, INDEX_CONFIGS, top_k=5)
+
+    if RUN_RETRIEVAL_MODE_BENCHMARK:
+        full_results["retrieval_modes"] = benchmark.evaluate_retrieval_modes(MODEL_ALLMINI, RETRIEVAL_MODES, top_k=5)
+
+    if RUN_RERANK_BENCHMARK:
+        full_results["rerank"] = benchmark.evaluate_reranker(MODEL_ALLMINI, candidates=RERANK_CANDIDATES, top_k=5)
+
+    if RUN_STORAGE_BENCHMARK:
+        full_results["storage"] = benchmark.evaluate_storages(MODEL_BGE_LARGE, STORAGES, top_k=5)
+
+    if RUN_ENCODER_BENCHMARK:
+        full_results["encoder_backends"] = benchmark.evaluate_encoder_backends(
+            MODEL_BGE_LARGE, ENCODER_BACKENDS, sample_size=ENCODER_SAMPLE_SIZE
+        )
+
     benchmark.save_results(full_results, OUTPUT_FILE)
     
     print("Benchmark evaluation complete!")
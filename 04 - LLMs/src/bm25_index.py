@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import re
+import numpy as np
+
+# Bumped when doc_text changes, so saved indexes are rebuilt
+TEXT_FORMAT_VERSION = 2
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-/][a-z0-9]+)*")
+# Small fixed list so the sparse index does not need spaCy at query time
+STOP_WORDS = frozenset("""
+a about above after again against all also an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her here
+hers herself him himself his how i if in into is it its itself just me more most my myself no nor not of off on
+once only or other our ours ourselves out over own same she should so some such than that the their theirs them
+themselves then there these they this those through to too under until up very was we were what when where
+which while who whom why will with would you your yours yourself yourselves entities wherein thereof therein
+""".split())
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOP_WORDS and len(token) > 1]
+
+
+class BM25Index:
+    """BM25 over title, abstract and entities with array-backed posting lists.
+
+    Postings are stored CSR-style: for term t, rows[offsets[t]:offsets[t + 1]] are the docs that contain it
+    and weights[...] their precomputed BM25 impact (idf * saturated tf), so a query is a few slice sums.
+    """
+
+    FILES = ("offsets.npy", "rows.npy", "weights.npy")
+
+    def __init__(self, vocab, offsets, rows, weights, ids, signature=None):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self.ids = ids
+        self.signature = signature
+
+    @staticmethod
+    def doc_text(doc):
+        # doc["text"] already is "title\nabstract\nEntities: [...]", entities are counted once
+        return doc.get("text", "")
+
+    @staticmethod
+    def docs_signature(docs):
+        digest = hashlib.sha1(f"bm25-v{TEXT_FORMAT_VERSION}".encode("utf-8"))
+        for doc in docs:
+            digest.update(doc["id"].encode("utf-8"))
+            digest.update(doc.get("text", "").encode("utf-8"))
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, docs, k1=1.2, b=0.75):
+        vocab = {}
+        term_ids = []
+        doc_rows = []
+        counts = []
+        doc_len = np.zeros(len(docs), dtype=np.float32)
+
+        for row, doc in enumerate(docs):
+            tokens = tokenize(cls.doc_text(doc))
+            doc_len[row] = len(tokens)
+            tf = {}
+            for token in tokens:
+                term = vocab.setdefault(token, len(vocab))
+                tf[term] = tf.get(term, 0) + 1
+            term_ids.extend(tf.keys())
+            counts.extend(tf.values())
+            doc_rows.extend([row] * len(tf))
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        rows = np.asarray(doc_rows, dtype=np.int32)
+        tf = np.asarray(counts, dtype=np.float32)
+
+        order = np.argsort(term_ids, kind="stable")
+        term_ids, rows, tf = term_ids[order], rows[order], tf[order]
+
+        df = np.bincount(term_ids, minlength=len(vocab))
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:])
+        df = df.astype(np.float32)
+
+        n = max(len(docs), 1)
+        idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(doc_len.mean()) if len(docs) else 1.0
+        norm = k1 * (1 - b + b * doc_len[rows] / max(avgdl, 1e-6))
+        weights = (idf[term_ids] * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+
+        return cls(vocab, offsets, rows, weights, [doc["id"] for doc in docs], cls.docs_signature(docs))
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        for name, array in zip(self.FILES, (self.offsets, self.rows, self.weights)):
+            np.save(os.path.join(folder, name), array)
+        with open(os.path.join(folder, "bm25.json"), "w") as f:
+            json.dump({"vocab": self.vocab, "ids": self.ids, "signature": self.signature}, f)
+
+    @classmethod
+    def load(cls, folder):
+        arrays = [np.load(os.path.join(folder, name), mmap_mode="r") for name in cls.FILES]
+        with open(os.path.join(folder, "bm25.json"), "r") as f:
+            meta = json.load(f)
+        return cls(meta["vocab"], *arrays, meta["ids"], meta.get("signature"))
+
+    @classmethod
+    def load_or_build(cls, folder, docs):
+        """Reuses the index saved in folder when it was built from the same docs, otherwise rebuilds it."""
+        signature = cls.docs_signature(docs)
+        try:
+            index = cls.load(folder)
+            if index.signature == signature:
+                print(f"BM25 index loaded from {folder}")
+                return index
+        except FileNotFoundError:
+            pass
+        print(f"Building BM25 index for {len(docs)} documents...")
+        index = cls.build(docs)
+        index.save(folder)
+        return index
+
+    def search(self, query_text, top_k=10, mask=None):
+        """Returns (rows, scores) of the top_k docs by BM25, best first. mask (bool per row) restricts the docs."""
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for token in set(tokenize(query_text)):
+            term = self.vocab.get(token)
+            if term is None:
+                continue
+            start, end = self.offsets[term], self.offsets[term + 1]
+            scores[self.rows[start:end]] += self.weights[start:end]
+
+        if mask is not None:
+            scores[~mask] = 0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return candidates, scores[candidates]
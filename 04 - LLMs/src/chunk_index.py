@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import faiss
+import numpy as np
+from doc_store import DocStore
+from faiss_index import FAISSIndex, read_index, search_params
+
+AGGREGATIONS = ("max", "sum")
+
+
+def chunk_words(text, window=200, overlap=50):
+    """Overlapping windows of window words, each starting window - overlap words after the previous one."""
+    words = text.split()
+    if not words:
+        return []
+    step = max(window - overlap, 1)
+    return [" ".join(words[start:start + window]) for start in range(0, max(len(words) - overlap, 1), step)]
+
+
+class ChunkIndex:
+    """Dense index over overlapping windows of each patent's full_description.
+
+    Built in one streaming pass: chunks are encoded block by block and appended to a raw float32 file,
+    so memory stays bounded by the block size. The vectors are then memory-mapped to train and fill the
+    FAISS index (any index_factory spec; compressed ones such as "IVF4096,PQ32" keep a 50-100x larger
+    index small). Each chunk maps to its patent through one int32 array, and chunk hits are aggregated
+    into patent scores at query time.
+    """
+
+    INDEX_FILE = "chunks.faiss"
+    VECTORS_FILE = "chunk_vectors.f32"
+    PARENTS_FILE = "chunk_parents.npy"
+    META_FILE = "chunks.json"
+    TEXTS_DIR = "chunk_texts"
+
+    def __init__(self, folder, nprobe=None, ef_search=None):
+        with open(os.path.join(folder, self.META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.patent_ids = self.meta["patent_ids"]
+        self.parents = np.load(os.path.join(folder, self.PARENTS_FILE), mmap_mode="r")
+        self.vectors = np.memmap(os.path.join(folder, self.VECTORS_FILE), dtype=np.float32, mode="r",
+                                 shape=(len(self.parents), self.meta["dim"]))
+        self.texts = DocStore(os.path.join(folder, self.TEXTS_DIR))
+        self.index = read_index(os.path.join(folder, self.INDEX_FILE))
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Same knobs as FAISSIndex, but each one is skipped when the chunk index type has no such parameter,
+        so the patent index settings can be passed through whatever the chunk spec is."""
+        params = faiss.ParameterSpace()
+        if nprobe is not None and faiss.try_extract_index_ivf(self.index) is not None:
+            params.set_index_parameter(self.index, "nprobe", nprobe)
+        if ef_search is not None and "HNSW" in self.meta["index_spec"]:
+            params.set_index_parameter(self.index, "efSearch", ef_search)
+
+    @staticmethod
+    def signature(patent_ids, window, overlap, index_spec, content_hashes=None):
+        """content_hashes (one per patent id, e.g. the sha1 of its file) make changed descriptions rebuild the index."""
+        digest = hashlib.sha1("\x1f".join([str(window), str(overlap), index_spec]).encode("utf-8"))
+        for i, patent_id in enumerate(patent_ids):
+            digest.update(patent_id.encode("utf-8"))
+            if content_hashes is not None:
+                digest.update(f"\x1f{content_hashes[i]}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, folder, records, encode, window=200, overlap=50, block_size=1024, index_spec="Flat",
+              train_size=100_000, add_block=65_536, signature=None):
+        """records yields (patent_id, title, description); encode maps a list of texts to an (n, d) array.
+
+        Chunk texts are embedded with the patent title in front, but only the window itself is stored."""
+        os.makedirs(os.path.join(folder, cls.TEXTS_DIR), exist_ok=True)
+        patent_ids = []
+        source_ids = []
+        parents = []
+        offsets = [0]
+        dim = None
+        block_texts, block_inputs = [], []
+
+        vectors_path = os.path.join(folder, cls.VECTORS_FILE)
+        texts_path = os.path.join(folder, cls.TEXTS_DIR, DocStore.DATA_FILE)
+        with open(vectors_path, "wb") as vectors_file, open(texts_path, "wb") as texts_file:
+            def flush():
+                nonlocal dim
+                vectors = np.asarray(encode(block_inputs), dtype=np.float32)
+                faiss.normalize_L2(vectors)
+                dim = vectors.shape[1]
+                vectors_file.write(vectors.tobytes())
+                for text in block_texts:
+                    record = json.dumps({"text": text}, ensure_ascii=False).encode("utf-8")
+                    texts_file.write(record)
+                    offsets.append(offsets[-1] + len(record))
+                block_texts.clear()
+                block_inputs.clear()
+
+            for patent_id, title, description in records:
+                source_ids.append(patent_id)
+                chunks = chunk_words(description, window, overlap)
+                if not chunks:
+                    continue
+                row = len(patent_ids)
+                patent_ids.append(patent_id)
+                for chunk in chunks:
+                    parents.append(row)
+                    block_texts.append(chunk)
+                    block_inputs.append(f"{title}\n{chunk}" if title else chunk)
+                    if len(block_inputs) >= block_size:
+                        flush()
+                        print(f"Encoded {len(parents)} chunks from {len(patent_ids)} patents")
+            if block_inputs:
+                flush()
+
+        if dim is None:
+            raise ValueError("No description text to chunk")
+
+        parents = np.asarray(parents, dtype=np.int32)
+        np.save(os.path.join(folder, cls.PARENTS_FILE), parents)
+        np.save(os.path.join(folder, cls.TEXTS_DIR, DocStore.OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+
+        vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(len(parents), dim))
+        index = FAISSIndex.build_index(vectors, index_spec, train_size)
+        for start in range(0, len(parents), add_block):
+            index.add(np.ascontiguousarray(vectors[start:start + add_block]))
+        faiss.write_index(index, os.path.join(folder, cls.INDEX_FILE))
+        del vectors
+
+        # The metadata file is written last, its presence marks a complete build
+        with open(os.path.join(folder, cls.META_FILE), "w") as f:
+            json.dump({
+                "patent_ids": patent_ids,
+                "dim": dim,
+                "window": window,
+                "overlap": overlap,
+                "index_spec": index_spec,
+                # Over every patent in records, those without a description included
+                "signature": signature or cls.signature(source_ids, window, overlap, index_spec),
+            }, f)
+        print(f"Chunk index built in {folder}: {len(parents)} chunks from {len(patent_ids)} patents")
+        return cls(folder)
+
+    @classmethod
+    def load_or_build(cls, folder, patent_ids, records, encode, window=200, overlap=50, index_spec="Flat",
+                      nprobe=None, ef_search=None, content_hashes=None, **build_args):
+        """Opens the index in folder when it was built from the same patents and settings, otherwise rebuilds it.
+
+        records is only consumed on a rebuild, so it can be a lazy generator over the patent files."""
+        signature = cls.signature(patent_ids, window, overlap, index_spec, content_hashes)
+        try:
+            index = cls(folder, nprobe=nprobe, ef_search=ef_search)
+            if index.meta.get("signature") == signature:
+                print(f"Chunk index loaded from {folder}")
+                return index
+            # The rebuild truncates the files this stale index still maps
+            index.texts.close()
+        except FileNotFoundError:
+            pass
+        print(f"Building chunk index for {len(patent_ids)} patents...")
+        index = cls.build(folder, records, encode, window=window, overlap=overlap, index_spec=index_spec,
+                          signature=signature, **build_args)
+        index.set_search_params(nprobe=nprobe, ef_search=ef_search)
+        return index
+
+    def search(self, query_vecs, top_k=3, aggregation="max", chunks_per_patent=8, parent_mask=None):
+        """Top patents per query from chunk hits, as lists of (patent_id, score, chunk rows best first).
+
+        aggregation "max" scores a patent by its best chunk (a cosine similarity), "sum" by the total of its
+        retrieved chunks. parent_mask (bool per patent row) restricts the search to those patents' chunks."""
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {aggregation}, expected one of {AGGREGATIONS}")
+        query_vecs = np.array(query_vecs, dtype=np.float32).reshape(-1, self.meta["dim"])
+        faiss.normalize_L2(query_vecs)
+
+        params = selector = None
+        if parent_mask is not None:
+            chunk_mask = np.asarray(parent_mask, dtype=bool)[self.parents]
+            if not chunk_mask.any():
+                return [[] for _ in query_vecs]
+            # The array form takes the packed bitmap and keeps it referenced while the selector lives
+            selector = faiss.IDSelectorBitmap(np.packbits(chunk_mask, bitorder="little"))
+            params = search_params(self.index, selector)
+        D, I = self.index.search(query_vecs, top_k * chunks_per_patent, params=params)
+
+        batch_results = []
+        for scores, rows in zip(D, I):
+            keep = rows != -1
+            scores, rows = scores[keep], rows[keep]
+            parents = np.asarray(self.parents[rows])
+            unique, first, inverse = np.unique(parents, return_index=True, return_inverse=True)
+            if aggregation == "max":
+                # Hits come best first, so a patent's first hit is its best chunk
+                patent_scores = scores[first]
+            else:
+                patent_scores = np.bincount(inverse, weights=scores, minlength=len(unique))
+            results = []
+            for u in np.argsort(-patent_scores, kind="stable")[:top_k]:
+                results.append((self.patent_ids[unique[u]], float(patent_scores[u]), rows[inverse == u].tolist()))
+            batch_results.append(results)
+        return batch_results
+
+    def chunk_text(self, row):
+        return self.texts[int(row)]["text"]
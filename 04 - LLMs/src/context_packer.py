@@ -0,0 +1,205 @@
+import math
+import re
+import textwrap
+from collections import Counter
+import numpy as np
+from bm25_index import tokenize
+
+# Templates are built once at import; a prompt is str.format on these instead of re-rendering an f-string
+PROMPT_TEMPLATE = textwrap.dedent("""\
+    You are an expert patent analyst. Follow these strict rules:
+
+    1) Use ONLY the information explicitly present in the CONTEXT.
+    Do NOT add external knowledge, interpretations, generalizations, or assumptions.
+
+    2) If the answer cannot be fully supported by the CONTEXT, respond exactly:
+    "insufficient evidence"
+
+    3) Every factual statement must cite the supporting patent ID(s) in parentheses.
+
+    4) At the end of the output, append exactly:
+    Referenced patent(s): {patent_ids}
+    Patent Score(s): {patent_scores}
+
+    QUESTION:
+    {query}
+
+    CONTEXT:
+    {context}
+    """)
+BLOCK_TEMPLATE = "PATENT {id} (score: {score})\nExcerpt:\n{excerpt}\nEntities:\n{entities}\n"
+BLOCK_SEPARATOR = "\n\n"
+
+SENTENCE_RE = re.compile(r"(?<=[.!?;])\s+|\n+")
+WORD_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_RE.split(text) if sentence.strip()]
+
+
+def doc_sentences(doc):
+    # doc["text"] ends with an "Entities: [...]" line, entities get their own section in the block
+    return split_sentences(doc.get("text", "").split("\nEntities:", 1)[0])
+
+
+class ContextPacker:
+    """Packs the most query-relevant sentences and chunks of the retrieved patents into a token budget.
+
+    Units are the sentences of each patent's title and abstract, plus, with chunk retrieval, the matching
+    description windows as whole passages. scoring picks how units are ranked:
+      dense    cosine between the query vector retrieval already computed and the units' precomputed vectors
+               (sentence_vectors.SentenceVectors for sentences, the chunk index vectors for passages), so
+               paraphrased evidence ranks like it did in retrieval. Near duplicates: cosine >= dedup_threshold.
+      lexical  BM25 against the query over the pool of retrieved units. Needs no vectors, but only rewards
+               sentences that share words with the query. Near duplicates: token-set Jaccard >=
+               lexical_dedup_threshold.
+    Dense falls back to lexical for a query whose units do not all have vectors (e.g. no sentence vectors
+    were built). Neither mode runs the encoder. The budget is filled greedily by score, counting tokens with
+    the encoder's own tokenizer, a local stand-in for the LLM's.
+    """
+
+    SCORINGS = ("dense", "lexical")
+
+    def __init__(self, vectorizer, max_tokens=1500, scoring="dense", sentence_vectors=None, dedup_threshold=0.95,
+                 lexical_dedup_threshold=0.8, max_entities=15, k1=1.2, b=0.75):
+        if scoring not in self.SCORINGS:
+            raise ValueError(f"Unknown context scoring {scoring}, expected one of {self.SCORINGS}")
+        self.vectorizer = vectorizer
+        self.max_tokens = max_tokens
+        self.scoring = scoring
+        self.sentence_vectors = sentence_vectors
+        self.dedup_threshold = dedup_threshold
+        self.lexical_dedup_threshold = lexical_dedup_threshold
+        self.max_entities = max_entities
+        self.k1 = k1
+        self.b = b
+        self.lexical_fallbacks = 0
+        self._template_tokens = None
+
+    def count_tokens(self, texts):
+        try:
+            return self.vectorizer.count_tokens(texts)
+        except AttributeError:
+            # No tokenizer on this encoder: words and punctuation are a close enough estimate
+            return [len(WORD_RE.findall(text)) for text in texts]
+
+    def template_tokens(self):
+        """Tokens of the fixed part of the prompt, counted once."""
+        if self._template_tokens is None:
+            empty = PROMPT_TEMPLATE.format(patent_ids="", patent_scores="", query="", context="")
+            self._template_tokens = self.count_tokens([empty])[0]
+        return self._template_tokens
+
+    def relevance(self, query_text, unit_tokens):
+        """BM25 of each unit for the query, idf and average length taken over these units."""
+        query_terms = set(tokenize(query_text))
+        n = len(unit_tokens)
+        lengths = np.array([len(tokens) for tokens in unit_tokens], dtype=np.float32)
+        avg_length = max(float(lengths.mean()), 1.0)
+        df = Counter(term for tokens in unit_tokens for term in set(tokens) & query_terms)
+        idf = {term: math.log(1 + (n - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+        scores = np.zeros(n, dtype=np.float32)
+        for i, tokens in enumerate(unit_tokens):
+            norm = self.k1 * (1 - self.b + self.b * lengths[i] / avg_length)
+            for term, tf in Counter(token for token in tokens if token in idf).items():
+                scores[i] += idf[term] * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def _is_duplicate(self, terms, picked_terms):
+        return bool(terms) and any(
+            len(terms & other) / len(terms | other) >= self.lexical_dedup_threshold for other in picked_terms
+        )
+
+    def _header(self, doc):
+        return BLOCK_TEMPLATE.format(
+            id=doc["id"], score=f"{doc['score'] * 100:.2f}%", excerpt="",
+            entities=", ".join(doc.get("entities", [])[:self.max_entities])
+        )
+
+    def _units(self, docs):
+        """(texts, owners, vectors) of the units of docs; vectors is None unless every unit has one."""
+        texts, owners, vectors = [], [], []
+        for d, doc in enumerate(docs):
+            sentences = doc_sentences(doc)
+            passages = doc.get("passages", [])
+            texts += sentences + passages
+            owners += [d] * (len(sentences) + len(passages))
+            if vectors is None:
+                continue
+            sentence_vecs = self.sentence_vectors.get(doc["id"]) if self.sentence_vectors is not None else None
+            passage_vecs = doc.get("passage_vectors")
+            if (sentence_vecs is None or len(sentence_vecs) != len(sentences)
+                    or (passages and (passage_vecs is None or len(passage_vecs) != len(passages)))):
+                vectors = None
+                continue
+            vectors += list(sentence_vecs) + (list(passage_vecs) if passages else [])
+        return texts, owners, vectors
+
+    def pack(self, query_text, docs, query_vec=None):
+        """Returns {doc id: excerpt} for the docs that made it into the budget, in the order of docs."""
+        budget = self.max_tokens - self.count_tokens([query_text])[0] - self.template_tokens()
+        texts, owners, vectors = self._units(docs)
+        if not texts or budget <= 0:
+            return {}
+
+        dense = self.scoring == "dense" and query_vec is not None and vectors is not None
+        if dense:
+            vectors = np.stack(vectors).astype(np.float32)
+            query_vec = np.asarray(query_vec, dtype=np.float32)
+            relevance = vectors @ (query_vec / (np.linalg.norm(query_vec) or 1.0))
+        else:
+            if self.scoring == "dense":
+                self.lexical_fallbacks += 1
+            unit_terms = [tokenize(text) for text in texts]
+            relevance = self.relevance(query_text, unit_terms)
+        costs = self.count_tokens(texts)
+        # A cited doc also costs its header block and its entry in the referenced ids / scores lines
+        header_costs = self.count_tokens([
+            self._header(doc) + f"{doc['id']}, {doc['score'] * 100:.2f}% precision, " for doc in docs
+        ])
+
+        picked = {}
+        picked_rows = []
+        picked_terms = []
+        for i in np.argsort(-relevance, kind="stable"):
+            d = owners[i]
+            cost = costs[i] + (header_costs[d] if d not in picked else 0)
+            if cost > budget:
+                continue
+            if dense:
+                if picked_rows and float(np.max(vectors[picked_rows] @ vectors[i])) >= self.dedup_threshold:
+                    continue
+                picked_rows.append(i)
+            else:
+                terms = set(unit_terms[i])
+                if self._is_duplicate(terms, picked_terms):
+                    continue
+                picked_terms.append(terms)
+            picked.setdefault(d, []).append(i)
+            budget -= cost
+
+        # Kept units go back in their original order inside each excerpt
+        return {docs[d]["id"]: " ".join(texts[i] for i in sorted(picked[d])) for d in sorted(picked)}
+
+    def build_prompt(self, query_text, docs, query_vec=None):
+        """Prompt for docs within the token budget. Returns (prompt, docs actually cited)."""
+        excerpts = self.pack(query_text, docs, query_vec)
+        cited = [doc for doc in docs if doc["id"] in excerpts]
+        if not cited:
+            return "insufficient evidence", []
+
+        blocks = [
+            BLOCK_TEMPLATE.format(
+                id=doc["id"], score=f"{doc['score'] * 100:.2f}%", excerpt=excerpts[doc["id"]],
+                entities=", ".join(doc.get("entities", [])[:self.max_entities])
+            )
+            for doc in cited
+        ]
+        prompt = PROMPT_TEMPLATE.format(
+            patent_ids=", ".join(doc["id"] for doc in cited),
+            patent_scores=", ".join(f"{doc['score'] * 100:.2f}% precision" for doc in cited),
+            query=query_text,
+            context=BLOCK_SEPARATOR.join(blocks),
+        )
+        return prompt, cited
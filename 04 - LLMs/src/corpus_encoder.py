@@ -0,0 +1,207 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+from tqdm import tqdm
+import model_registry
+
+# Model of each pool worker, loaded once by _init_worker
+_worker = {}
+
+
+def _init_worker(model_name, backend, threads):
+    _worker["model"] = model_registry.get_sentence_transformer(model_name, "cpu", backend=backend, threads=threads)
+
+
+def _capped_lengths(model, texts):
+    """Tokens per text, capped at the model's max_seq_length like the encoder does."""
+    ids = model.tokenizer(texts, add_special_tokens=True)["input_ids"]
+    return [min(len(row), model.max_seq_length) for row in ids]
+
+
+def _worker_dimension():
+    return _worker["model"].get_sentence_embedding_dimension()
+
+
+def _worker_lengths(texts):
+    return _capped_lengths(_worker["model"], texts)
+
+
+def _encode_batch(task):
+    rows, texts = task
+    vectors = _worker["model"].encode(texts, batch_size=len(texts), convert_to_numpy=True, show_progress_bar=False)
+    return rows, vectors
+
+
+class CorpusEncoder:
+    """Encodes a large list of texts in token-budget batches, optionally over a pool of processes.
+
+    Texts are sorted by token length (longest first) and grouped so that each batch pads to at most
+    max_tokens tokens, instead of fixed-count batches padding short abstracts to the longest one.
+    With a checkpoint path, vectors are written straight into their original rows of a memory-mapped
+    .npy file and the finished rows are saved every checkpoint_seconds, so an interrupted run resumes
+    where it stopped when it is given the same texts again.
+    """
+
+    def __init__(self, model_name, device=None, backend="torch", threads=None, processes=1,
+                 max_tokens=16384, max_batch=256, checkpoint_seconds=30):
+        self.model_name = model_name
+        self.device = device
+        self.backend = backend
+        self.threads = threads
+        self.processes = max(processes or 1, 1)
+        self.max_tokens = max_tokens
+        self.max_batch = max_batch
+        self.checkpoint_seconds = checkpoint_seconds
+
+    @property
+    def model(self):
+        return model_registry.get_sentence_transformer(
+            self.model_name, self.device, backend=self.backend, threads=self.threads
+        )
+
+    def token_lengths(self, texts, chunk_size=4096, pool=None):
+        """Tokens per text, capped at the model's max_seq_length like the encoder does.
+
+        With a pool the workers tokenize, so the parent process never loads the model."""
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+        if pool is None:
+            model = self.model
+            counted = (_capped_lengths(model, chunk) for chunk in chunks)
+        else:
+            counted = pool.imap(_worker_lengths, chunks)
+        return np.fromiter((length for lengths in counted for length in lengths), dtype=np.int32, count=len(texts))
+
+    def dimension(self, pool=None):
+        if pool is None:
+            return self.model.get_sentence_embedding_dimension()
+        return pool.apply(_worker_dimension)
+
+    @contextmanager
+    def _pool(self):
+        """The worker pool when processes > 1, None otherwise."""
+        if self.processes == 1:
+            yield None
+            return
+        # Each worker gets its share of the cores, so processes do not oversubscribe the CPU
+        threads = self.threads or max(1, (os.cpu_count() or 1) // self.processes)
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(self.processes, initializer=_init_worker,
+                          initargs=(self.model_name, self.backend, threads)) as pool:
+            yield pool
+
+    @staticmethod
+    def make_batches(rows, lengths, max_tokens=16384, max_batch=256):
+        """Splits rows, sorted by length longest first, into batches whose padded size fits max_tokens."""
+        order = rows[np.argsort(-lengths[rows], kind="stable")]
+        batches = []
+        start = 0
+        while start < len(order):
+            # The first row of a batch is its longest, so the batch pads to its length
+            size = max(1, min(max_batch, max_tokens // max(int(lengths[order[start]]), 1)))
+            batches.append(order[start:start + size])
+            start += size
+        return batches
+
+    @staticmethod
+    def signature(model_name, texts):
+        digest = hashlib.sha1(model_name.encode("utf-8"))
+        for text in texts:
+            digest.update(hashlib.sha1(text.encode("utf-8")).digest())
+        return digest.hexdigest()
+
+    @staticmethod
+    def checkpoint_files(checkpoint_path):
+        return {
+            "vectors": f"{checkpoint_path}.npy",
+            "done": f"{checkpoint_path}.done.npy",
+            "meta": f"{checkpoint_path}.json",
+        }
+
+    @classmethod
+    def remove_checkpoint(cls, checkpoint_path):
+        for path in cls.checkpoint_files(checkpoint_path).values():
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _open_output(self, texts, dim, checkpoint_path):
+        """(vectors, done) for texts: a resumed checkpoint, a new one, or in-memory arrays without a path."""
+        if checkpoint_path is None:
+            return np.empty((len(texts), dim), dtype=np.float32), np.zeros(len(texts), dtype=bool)
+
+        files = self.checkpoint_files(checkpoint_path)
+        signature = self.signature(self.model_name, texts)
+        try:
+            with open(files["meta"], "r") as f:
+                meta = json.load(f)
+            if meta == {"signature": signature, "count": len(texts), "dim": dim}:
+                vectors = np.lib.format.open_memmap(files["vectors"], mode="r+")
+                done = np.load(files["done"])
+                print(f"Resuming encode from {files['vectors']}: {int(done.sum())}/{len(texts)} done")
+                return vectors, done
+        except (FileNotFoundError, ValueError):
+            pass
+
+        os.makedirs(os.path.dirname(files["vectors"]) or ".", exist_ok=True)
+        vectors = np.lib.format.open_memmap(files["vectors"], mode="w+", dtype=np.float32, shape=(len(texts), dim))
+        done = np.zeros(len(texts), dtype=bool)
+        self._save_done(files["done"], done)
+        with open(files["meta"], "w") as f:
+            json.dump({"signature": signature, "count": len(texts), "dim": dim}, f)
+        return vectors, done
+
+    @staticmethod
+    def _save_done(done_file, done):
+        tmp_file = done_file[:-len(".npy")] + ".tmp.npy"
+        np.save(tmp_file, done)
+        os.replace(tmp_file, done_file)
+
+    def _results(self, texts, batches, pool=None):
+        """Yields (rows, vectors) per batch, in completion order when a pool is used."""
+        tasks = ((rows, [texts[i] for i in rows]) for rows in batches)
+        if pool is not None:
+            yield from pool.imap_unordered(_encode_batch, tasks)
+            return
+
+        model = self.model
+        for rows, batch in tasks:
+            yield rows, model.encode(batch, batch_size=len(batch), convert_to_numpy=True, show_progress_bar=False)
+
+    def encode(self, texts, checkpoint_path=None):
+        """(len(texts), dim) float32 vectors in the order of texts.
+
+        With processes > 1 the model is only loaded by the workers, which also tokenize."""
+        texts = list(texts)
+        with self._pool() as pool:
+            return self._encode(texts, checkpoint_path, pool)
+
+    def _encode(self, texts, checkpoint_path, pool):
+        vectors, done = self._open_output(texts, self.dimension(pool), checkpoint_path)
+        pending = np.flatnonzero(~done)
+        if len(pending) == 0:
+            return np.array(vectors)
+
+        # Only the texts still to encode are tokenized, a resumed run skips the finished ones
+        lengths = np.zeros(len(texts), dtype=np.int32)
+        lengths[pending] = self.token_lengths([texts[i] for i in pending], pool=pool)
+        batches = self.make_batches(pending, lengths, self.max_tokens, self.max_batch)
+        print(f"Encoding {len(pending)} texts in {len(batches)} token-budget batches with {self.processes} process(es)")
+        last_checkpoint = time.monotonic()
+        with tqdm(total=len(texts), initial=len(texts) - len(pending), desc="Encoding corpus") as progress:
+            for rows, batch_vectors in self._results(texts, batches, pool):
+                vectors[rows] = batch_vectors
+                done[rows] = True
+                progress.update(len(rows))
+                if checkpoint_path is not None and time.monotonic() - last_checkpoint >= self.checkpoint_seconds:
+                    # Vectors reach the disk before the rows are marked done
+                    vectors.flush()
+                    self._save_done(self.checkpoint_files(checkpoint_path)["done"], done)
+                    last_checkpoint = time.monotonic()
+
+        if checkpoint_path is not None:
+            vectors.flush()
+            self._save_done(self.checkpoint_files(checkpoint_path)["done"], done)
+        return np.array(vectors)
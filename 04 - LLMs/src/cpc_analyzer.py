@@ -4,6 +4,8 @@ import random
 from pathlib import Path
 from collections import defaultdict
 from typing import Dict, List, Tuple
+import numpy as np
+from patent_table import PatentTable
 
 
 DEFAULT_DATASET_PATH = "../../dataset/2016"
@@ -12,27 +14,27 @@ DEFAULT_TOP_N = 10
 
 
 class CPCAnalyzer:
-    def __init__(self, dataset_path: str):
+    def __init__(self, dataset_path: str, table_dir: str = None):
         self.dataset_path = Path(dataset_path)
+        # Columnar metadata extracted once from the JSON files (see patent_table.py)
+        self.table_dir = table_dir or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "cache", f"patent_table_{self.dataset_path.name}"
+        )
+        self.table = None
         self.cpc_to_files: Dict[str, List[str]] = defaultdict(list)
         self.cpc_counts: Dict[str, int] = defaultdict(int)
     
     def analyze(self):
-        json_files = list(self.dataset_path.glob("*.json"))
-        
-        for file_path in json_files:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                main_cpc = data.get("main_cpc_label", "")
-                if main_cpc:
-                    self.cpc_to_files[main_cpc].append(file_path.name)
-                    self.cpc_counts[main_cpc] += 1
-                    
-            except (json.JSONDecodeError, KeyError) as e:
-                print(f"Error processing {file_path.name}: {e}")
-                continue
+        self.table = PatentTable.load_or_build(self.table_dir, self.dataset_path)
+        main_cpc = np.asarray(self.table.main_cpc)
+        rows = np.flatnonzero(main_cpc >= 0)
+        # One sort groups the rows by label instead of a dict append per patent
+        rows = rows[np.argsort(main_cpc[rows], kind="stable")]
+        labels, starts = np.unique(main_cpc[rows], return_index=True)
+        for code, group in zip(labels.tolist(), np.split(rows, starts[1:])):
+            label = self.table.cpc_vocab[code]
+            self.cpc_to_files[label] = [f"{patent_id}.json" for patent_id in self.table.ids[group].tolist()]
+            self.cpc_counts[label] = len(group)
     
     def get_top_n(self, n: int = 10) -> List[Tuple[str, int]]:
         return sorted(self.cpc_counts.items(), key=lambda x: x[1], reverse=True)[:n]
@@ -1,74 +1,242 @@
+import hashlib
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
+from bm25_index import BM25Index
 from ner_handler import NERHandler
 from tqdm import tqdm
 
+# Bumped when the fields kept in each cached doc change, so old caches are rebuilt
+DOC_FORMAT_VERSION = 2
+
 class DataHandler:
     def __init__(self, folder: str):
         self.folder = Path(folder)
         self.ner = NERHandler()
-    
+        # sha1 of each patent file, by id, as of the last cached load_texts
+        self.file_hashes = {}
+
     def get_ner_model_name(self):
         return self.ner.get_model_name()
-    
-    def _load_texts_and_create_cache(self, dataset_tag=None, ner_model_name=None, data_file=None):
-        docs = []
-        texts = []
 
-        files = list(self.folder.glob("*.json"))
-        for file in tqdm(files, desc="Processing patent files", leave=True):
+    def _read_patent(self, file):
+        # Keep only the fields used for indexing, so full_description is released right away
+        with open(file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        return {
+            "id": file.stem,
+            "title": data.get("title", ""),
+            "abstract": data.get("abstract", ""),
+            "metadata": {
+                "filing_date": data.get("filing_date"),
+                "patent_issue_date": data.get("patent_issue_date"),
+                "main_cpc_label": data.get("main_cpc_label"),
+            },
+        }
+
+    def _build_doc(self, record, entities):
+        text = "\n".join([
+            record["title"], record["abstract"]
+        ]).strip()
+        text = f"{text}\nEntities: {entities}"
+
+        return {
+            "id": record["id"],
+            "text": text,
+            "entities": entities,
+            "metadata": record["metadata"],
+        }
+
+    def _read_patents(self, files, n_workers, chunk_size):
+        # pool.map keeps the input order; chunking bounds how many records are in flight
+        files = iter(files)
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            while True:
+                chunk = list(islice(files, chunk_size))
+                if not chunk:
+                    break
+                yield from pool.map(self._read_patent, chunk)
+
+    def iter_descriptions(self, files=None):
+        """Yields (id, title, full_description) one patent at a time, for chunk indexing."""
+        if files is None:
+            files = sorted(self.folder.glob("*.json"))
+        for file in files:
             with open(file, "r", encoding="utf-8") as f:
                 data = json.load(f)
+            yield file.stem, data.get("title", ""), data.get("full_description") or ""
 
-            title = data.get("title", "")
-            abstract = data.get("abstract", "")
-        
-            text = "\n".join([
-                title, abstract
-            ]).strip()
+    def stream_docs(self, files=None, batch_size=64, n_process=1, n_workers=8):
+        """Yields processed docs in sorted file order, reading files in parallel and running spaCy with nlp.pipe."""
+        if files is None:
+            files = sorted(self.folder.glob("*.json"))
+        records = self._read_patents(files, n_workers, chunk_size=batch_size * n_workers)
+        items = ((record["abstract"], record) for record in records)
+
+        for entities, record in self.ner.pipe_entities(items, batch_size=batch_size, n_process=n_process):
+            yield self._build_doc(record, entities)
+
+    def _process_files(self, files, batched=False, batch_size=64, n_process=1, n_workers=8):
+        docs = []
+
+        start = time.perf_counter()
+        if batched:
+            stream = self.stream_docs(files, batch_size=batch_size, n_process=n_process, n_workers=n_workers)
+            for doc in tqdm(stream, total=len(files), desc="Processing patent files (batched)", leave=True):
+                docs.append(doc)
+        else:
+            for file in tqdm(files, desc="Processing patent files", leave=True):
+                record = self._read_patent(file)
+                entities = self.ner.extract_entities(record["abstract"])
+                docs.append(self._build_doc(record, entities))
+
+        elapsed = time.perf_counter() - start
+        rate = len(docs) / elapsed if elapsed > 0 else 0.0
+        print(f"Processed {len(docs)} documents in {elapsed:.2f}s ({rate:.1f} docs/sec)")
+
+        return docs
+
+    def _hash_file(self, file):
+        digest = hashlib.sha1()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _fingerprint(self, file, previous=None):
+        # Only hash the content when size/mtime moved, so an unchanged folder costs one stat per file
+        stat = file.stat()
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+            fingerprint["sha1"] = previous["sha1"]
+        else:
+            fingerprint["sha1"] = self._hash_file(file)
+        return fingerprint
+
+    def _load_cache(self, data_file, ner_model_name):
+        try:
+            with open(data_file, "r") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            print(f"Cache file {data_file} not found, processing files...")
+            return {}
+
+        if isinstance(cache, list):
+            # Legacy all-or-nothing cache: doc format 1, its docs lack the metadata the filters need
+            print(f"Cache {data_file} has an older doc format, processing files...")
+            return {}
+
+        if (cache.get("ner_model") != ner_model_name
+                or cache.get("cleaning_version") != self.ner.get_cleaning_version()):
+            print(f"Cache {data_file} was built with other NER settings, processing files...")
+            return {}
+
+        if cache.get("doc_format", 1) != DOC_FORMAT_VERSION:
+            print(f"Cache {data_file} has an older doc format, processing files...")
+            return {}
+
+        return cache["entries"]
+
+    def _save_cache(self, data_file, ner_model_name, entries):
+        os.makedirs(os.path.dirname(data_file), exist_ok=True)
+        cache = {
+            "ner_model": ner_model_name,
+            "cleaning_version": self.ner.get_cleaning_version(),
+            "doc_format": DOC_FORMAT_VERSION,
+            "entries": entries,
+        }
+        tmp_file = f"{data_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, data_file)
+        print(f"Cache saved to {data_file}")
+
+    def load_texts(self, dataset_tag=None, ner_model_name=None, batched=False, batch_size=64, n_process=1, n_workers=8):
+        process_kwargs = dict(batched=batched, batch_size=batch_size, n_process=n_process, n_workers=n_workers)
+
+        if not (dataset_tag and ner_model_name):
+            docs = self._process_files(sorted(self.folder.glob("*.json")), **process_kwargs)
+            return [doc["text"] for doc in docs], docs
 
-            metadata = {
-                "filing_date": data.get("filing_date"),
-                "patent_issue_date": data.get("patent_issue_date"),
-            }
-
-            entities = self.ner.extract_entities(abstract)
-            text = f"{text}\nEntities: {entities}"
-
-            docs.append({  
-                "id": file.stem,
-                "text": text, 
-                "entities": entities,    
-                "metadata": metadata, 
-            })
-
-            texts.append(text)
-
-        if dataset_tag and ner_model_name:
-            data_file = f"cache/data_{dataset_tag}_{ner_model_name}.json"
-            with open(data_file, "w") as f:
-                json.dump(docs, f, indent=2)
-            print(f"Cache saved to {data_file}")
-        
-        return texts, docs
-        
-    def load_texts(self, dataset_tag=None, ner_model_name=None):
         BASE_DIR = os.path.dirname(os.path.abspath(__file__))
         CACHE_DIR = os.path.join(BASE_DIR, "cache")
         data_file = os.path.join(CACHE_DIR, f"data_{dataset_tag}_{ner_model_name}.json")
-        
-        if dataset_tag and ner_model_name:
-            try:
-                with open(data_file, "r") as f:
-                    docs = json.load(f)
-                    texts = [doc["text"] for doc in docs]
-                    print(f"Loaded {len(docs)} documents from cache: {data_file}")
-                    return texts, docs
-
-            except FileNotFoundError:
-                print(f"Cache file {data_file} not found, processing files...")
-        
-        texts, docs = self._load_texts_and_create_cache(dataset_tag, ner_model_name, data_file)
+
+        entries = self._load_cache(data_file, ner_model_name)
+        files = {file.stem: file for file in sorted(self.folder.glob("*.json"))}
+
+        updated = {}
+        fingerprints = {}
+        changed = []
+        touched = False
+        for doc_id, file in files.items():
+            previous = entries.get(doc_id)
+            fingerprint = self._fingerprint(file, previous)
+            if previous is not None and previous.get("sha1") == fingerprint["sha1"]:
+                touched = touched or previous.get("mtime_ns") != fingerprint["mtime_ns"]
+                updated[doc_id] = {**fingerprint, "doc": previous["doc"]}
+            else:
+                fingerprints[doc_id] = fingerprint
+                changed.append(file)
+
+        removed = [doc_id for doc_id in entries if doc_id not in files]
+
+        if changed:
+            for doc in self._process_files(changed, **process_kwargs):
+                updated[doc["id"]] = {**fingerprints[doc["id"]], "doc": doc}
+
+        # Keep the previous order for surviving docs and append new ones, so row positions stay stable
+        order = [doc_id for doc_id in entries if doc_id in updated]
+        order += [doc_id for doc_id in updated if doc_id not in entries]
+        entries = {doc_id: updated[doc_id] for doc_id in order}
+        self.file_hashes = {doc_id: entry["sha1"] for doc_id, entry in entries.items()}
+
+        print(f"Cache {data_file}: {len(entries) - len(changed)} unchanged, "
+              f"{len(changed)} processed, {len(removed)} removed")
+        if changed or removed or touched:
+            self._save_cache(data_file, ner_model_name, entries)
+
+        docs = [entry["doc"] for entry in entries.values()]
+        texts = [doc["text"] for doc in docs]
         return texts, docs
-        
\ No newline at end of file
+
+    def load_sparse_index(self, docs, dataset_tag, ner_model_name):
+        """BM25 index over the cached docs, stored next to the doc cache and rebuilt when the docs change."""
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        CACHE_DIR = os.path.join(BASE_DIR, "cache")
+        return BM25Index.load_or_build(os.path.join(CACHE_DIR, f"bm25_{dataset_tag}_{ner_model_name}"), docs)
+
+    def load_chunk_index(self, docs, dataset_tag, vectorizer, index_spec="Flat", nprobe=None, ef_search=None):
+        """Chunk index over the full descriptions of docs, rebuilt when the patents or the index spec change."""
+        # faiss is only imported by callers that use chunk retrieval
+        from chunk_index import ChunkIndex
+
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        CACHE_DIR = os.path.join(BASE_DIR, "cache")
+        folder = os.path.join(CACHE_DIR, f"chunks_{dataset_tag}_{vectorizer.get_model_tag()}")
+        patent_ids = [doc["id"] for doc in docs]
+        files = [self.folder / f"{patent_id}.json" for patent_id in patent_ids]
+        # File hashes make a changed description rebuild the index even when the ids are the same
+        content_hashes = [
+            self.file_hashes.get(patent_id) or self._hash_file(file) for patent_id, file in zip(patent_ids, files)
+        ]
+        return ChunkIndex.load_or_build(
+            folder, patent_ids, self.iter_descriptions(files),
+            lambda texts: vectorizer.encode_texts(texts, show_progress_bar=False),
+            index_spec=index_spec, nprobe=nprobe, ef_search=ef_search, content_hashes=content_hashes
+        )
+
+    def load_sentence_vectors(self, docs, dataset_tag, vectorizer):
+        """Vectors of the excerpt sentences of docs for dense context packing, rebuilt when the docs change."""
+        from sentence_vectors import SentenceVectors
+
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        CACHE_DIR = os.path.join(BASE_DIR, "cache")
+        folder = os.path.join(CACHE_DIR, f"sentences_{dataset_tag}_{vectorizer.get_model_tag()}")
+        return SentenceVectors.load_or_build(
+            folder, docs, lambda texts: vectorizer.encode_texts(texts, show_progress_bar=False)
+        )
@@ -0,0 +1,58 @@
+import json
+import mmap
+import os
+import numpy as np
+
+
+class DocStore:
+    """Read-only docs addressed by row: one JSON record per row in docs.bin, row offsets in docs.idx.npy."""
+
+    DATA_FILE = "docs.bin"
+    OFFSETS_FILE = "docs.idx.npy"
+    IDS_FILE = "ids.json"
+
+    @classmethod
+    def write(cls, folder, docs):
+        os.makedirs(folder, exist_ok=True)
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        with open(os.path.join(folder, cls.DATA_FILE), "wb") as f:
+            for row, doc in enumerate(docs):
+                record = json.dumps(doc, ensure_ascii=False).encode("utf-8")
+                f.write(record)
+                offsets[row + 1] = offsets[row] + len(record)
+        np.save(os.path.join(folder, cls.OFFSETS_FILE), offsets)
+        with open(os.path.join(folder, cls.IDS_FILE), "w") as f:
+            json.dump([doc["id"] for doc in docs], f)
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.offsets = np.load(os.path.join(folder, self.OFFSETS_FILE), mmap_mode="r")
+        # Stores written without ids (e.g. chunk texts) are addressed by row only
+        ids_file = os.path.join(folder, self.IDS_FILE)
+        self.ids = None
+        if os.path.exists(ids_file):
+            with open(ids_file, "r") as f:
+                self.ids = json.load(f)
+
+        self._file = open(os.path.join(folder, self.DATA_FILE), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap refuses empty files
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return json.loads(self._data[start:end].decode("utf-8"))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
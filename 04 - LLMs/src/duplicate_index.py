@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import faiss
+import numpy as np
+from faiss_index import FAISSIndex
+
+
+class DuplicateClusters:
+    """Near-duplicate patents (continuations, re-filings) grouped into clusters, one int32 per doc.
+
+    Built offline by a kNN self-join over the cached vectors: the corpus is searched against itself
+    block_size queries at a time and every neighbour pair at cosine >= threshold is linked. Memory stays
+    at n * k per block instead of an n x n matrix. Linked docs are merged with union-find; cluster[row] is
+    the cluster number, or -1 for docs without a duplicate.
+    """
+
+    FILE = "duplicates.npz"
+    META_FILE = "duplicates.json"
+
+    def __init__(self, ids, cluster, signature=None):
+        self.ids = ids
+        self.cluster = cluster
+        self.signature = signature
+
+    @staticmethod
+    def docs_signature(docs, threshold, k):
+        digest = hashlib.sha1(f"{threshold}\x1f{k}".encode("utf-8"))
+        for doc in docs:
+            digest.update(doc["id"].encode("utf-8"))
+            digest.update(doc.get("text", "").encode("utf-8"))
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, ids, vectors, threshold=0.95, k=10, block_size=4096, index_spec="Flat", train_size=100_000):
+        """Clusters the rows of vectors (same order as ids). index_spec picks the search index of the self-join,
+        e.g. "IVF4096,Flat" with nprobe defaults trades a little recall for a much faster pass on a full year."""
+        n = vectors.shape[0]
+        index = FAISSIndex.build_index(vectors, index_spec, train_size)
+        for start in range(0, n, block_size):
+            block = np.array(vectors[start:start + block_size], dtype=np.float32)
+            faiss.normalize_L2(block)
+            index.add(block)
+
+        parent = np.arange(n, dtype=np.int64)
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        links = 0
+        for start in range(0, n, block_size):
+            block = np.array(vectors[start:start + block_size], dtype=np.float32)
+            faiss.normalize_L2(block)
+            D, I = index.search(block, k + 1)
+            rows = np.arange(start, start + len(block))[:, None]
+            # Neighbours come best first, so only the head of each row can pass the threshold
+            linked = (I != -1) & (I != rows) & (D >= threshold)
+            for a, b in zip(np.broadcast_to(rows, I.shape)[linked].tolist(), I[linked].tolist()):
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+                    links += 1
+            if start // block_size % 10 == 0:
+                print(f"Self-join: {min(start + block_size, n)}/{n} patents, {links} duplicate links")
+
+        roots = np.array([find(i) for i in range(n)], dtype=np.int64)
+        sizes = np.bincount(roots, minlength=n)
+        cluster_roots = np.flatnonzero(sizes > 1)
+        cluster_of_root = np.full(n, -1, dtype=np.int32)
+        cluster_of_root[cluster_roots] = np.arange(len(cluster_roots), dtype=np.int32)
+        cluster = cluster_of_root[roots]
+        print(f"{len(cluster_roots)} duplicate clusters covering {int((cluster >= 0).sum())} of {n} patents")
+        return cls(list(ids), cluster)
+
+    def members(self, doc_id):
+        """Doc ids in the same cluster as doc_id, itself included."""
+        row = self.ids.index(doc_id)
+        if self.cluster[row] < 0:
+            return [doc_id]
+        return [self.ids[i] for i in np.flatnonzero(self.cluster == self.cluster[row])]
+
+    def detach(self, doc_ids):
+        """Takes doc_ids out of their clusters, e.g. patents whose text changed since the clusters were built."""
+        rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        for doc_id in doc_ids:
+            row = rows.get(doc_id)
+            if row is not None:
+                self.cluster[row] = -1
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.savez(os.path.join(folder, self.FILE), cluster=self.cluster)
+        with open(os.path.join(folder, self.META_FILE), "w") as f:
+            json.dump({"ids": self.ids, "signature": self.signature}, f)
+
+    @classmethod
+    def load(cls, folder):
+        with np.load(os.path.join(folder, cls.FILE)) as arrays:
+            cluster = arrays["cluster"]
+        with open(os.path.join(folder, cls.META_FILE), "r") as f:
+            meta = json.load(f)
+        return cls(meta["ids"], cluster, meta.get("signature"))
+
+    @classmethod
+    def load_or_build(cls, folder, docs, vectors, threshold=0.95, k=10, **build_args):
+        """Reuses the clusters saved in folder when they were built from the same docs and settings."""
+        signature = cls.docs_signature(docs, threshold, k)
+        try:
+            clusters = cls.load(folder)
+            if clusters.signature == signature:
+                print(f"Duplicate clusters loaded from {folder}")
+                return clusters
+        except FileNotFoundError:
+            pass
+        print(f"Finding near-duplicates among {len(docs)} patents (cosine >= {threshold})...")
+        clusters = cls.build([doc["id"] for doc in docs], vectors, threshold=threshold, k=k, **build_args)
+        clusters.signature = signature
+        clusters.save(folder)
+        return clusters
@@ -0,0 +1,148 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of query embeddings with optional TTL and an optional sqlite tier that survives restarts.
+
+    The sqlite tier is bounded too: writes are committed every commit_every puts or commit_seconds, and each
+    commit deletes expired rows and the oldest ones beyond max_disk_size.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, path=None, lowercase=False, max_disk_size=100_000,
+                 commit_every=64, commit_seconds=5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lowercase = lowercase
+        self.max_disk_size = max_disk_size
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        self._db = None
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, created REAL, dim INTEGER, vector BLOB)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created)")
+            with self._lock:
+                self._commit()
+
+    def normalize(self, text):
+        text = " ".join(text.split())
+        return text.lower() if self.lowercase else text
+
+    def make_key(self, model_name, text, instruction=""):
+        raw = "\x1f".join([model_name, instruction, self.normalize(text)])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, vector = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT created, dim, vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    vector = np.frombuffer(row[2], dtype=np.float32).reshape(row[1])
+                    self._insert(key, row[0], vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, key, vector):
+        vector = np.array(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        created = time.time()
+        with self._lock:
+            self._insert(key, created, vector)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                    (key, created, vector.shape[0], vector.tobytes())
+                )
+                # One commit (and fsync) per batch of puts instead of one per new query
+                self._pending += 1
+                if (self._pending >= self.commit_every
+                        or time.monotonic() - self._last_commit >= self.commit_seconds):
+                    self._commit()
+
+    def _commit(self):
+        """Prunes the sqlite tier to its TTL and max_disk_size and commits. Called with the lock held."""
+        if self.ttl is not None:
+            self.disk_evictions += self._db.execute(
+                "DELETE FROM embeddings WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+        if self.max_disk_size is not None:
+            self.disk_evictions += self._db.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_disk_size,)
+            ).rowcount
+        self._db.commit()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        """Commits puts still pending in the sqlite tier."""
+        with self._lock:
+            if self._db is not None and self._pending:
+                self._commit()
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _insert(self, key, created, vector):
+        self._entries[key] = (created, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._commit()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+class EmbeddingStore:
+    """Embedding matrix keyed by doc id, saved as vectors_*.npy with an id->row file next to it."""
+
+    def __init__(self, vectors_file, model_name, dim):
+        self.vectors_file = vectors_file
+        self.ids_file = os.path.splitext(vectors_file)[0] + ".ids.json"
+        self.model_name = model_name
+        self.dim = dim
+        self.ids = []
+        self.hashes = []
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def load(self, legacy_ids=None, legacy_texts=None, mmap=False):
+        """mmap leaves the matrix on disk (read-only), rows are paged in as they are read."""
+        try:
+            vectors = np.load(self.vectors_file, mmap_mode="r" if mmap else None)
+        except FileNotFoundError:
+            print(f"Vectors file {self.vectors_file} not found")
+            return False
+
+        adopted = False
+        try:
+            with open(self.ids_file, "r") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            # Legacy matrix without ids: only trust it if it lines up with the current docs
+            if legacy_ids is None or len(legacy_ids) != vectors.shape[0]:
+                print(f"Discarding {self.vectors_file}: no id mapping and row count does not match")
+                return False
+            print(f"Adopting legacy vectors {self.vectors_file} in current doc order")
+            meta = {
+                "model_name": self.model_name,
+                "dim": int(vectors.shape[1]),
+                "ids": list(legacy_ids),
+                "hashes": [self.text_hash(text) for text in legacy_texts],
+            }
+            adopted = True
+
+        ids = meta.get("ids", [])
+        hashes = meta.get("hashes", [])
+        if (meta.get("model_name") != self.model_name
+                or meta.get("dim") != self.dim
+                or vectors.ndim != 2
+                or vectors.shape != (len(ids), self.dim)
+                or len(hashes) != len(ids)
+                or len(set(ids)) != len(ids)):
+            print(f"Discarding {self.vectors_file}: id mapping does not match the matrix or the model")
+            return False
+
+        self.ids = ids
+        self.hashes = hashes
+        self.vectors = vectors.astype(np.float32, copy=False)
+        if adopted:
+            self.save()
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.vectors_file) or ".", exist_ok=True)
+        # np.save appends .npy to names that lack it, so keep the suffix on the temp file
+        tmp_vectors = self.vectors_file[:-len(".npy")] + ".tmp.npy"
+        tmp_ids = f"{self.ids_file}.tmp"
+        np.save(tmp_vectors, self.vectors)
+        with open(tmp_ids, "w") as f:
+            json.dump({
+                "model_name": self.model_name,
+                "dim": self.dim,
+                "ids": self.ids,
+                "hashes": self.hashes,
+            }, f)
+        os.replace(tmp_vectors, self.vectors_file)
+        os.replace(tmp_ids, self.ids_file)
+
+    def sync(self, docs, texts, encode):
+        """Aligns the store with docs, encoding only new or changed ones. Returns (vectors, added_ids, removed_ids)."""
+        row_of = {(doc_id, text_hash): row for row, (doc_id, text_hash) in enumerate(zip(self.ids, self.hashes))}
+        doc_ids = [doc["id"] for doc in docs]
+        doc_hashes = [self.text_hash(text) for text in texts]
+        keys = list(zip(doc_ids, doc_hashes))
+        wanted = set(doc_ids)
+
+        missing = [i for i, key in enumerate(keys) if key not in row_of]
+        removed_ids = [doc_id for doc_id in self.ids if doc_id not in wanted]
+
+        if missing:
+            print(f"Encoding {len(missing)} new documents ({len(keys) - len(missing)} cached)")
+            new_vectors = encode([texts[i] for i in missing]).astype(np.float32)
+        else:
+            new_vectors = np.empty((0, self.dim), dtype=np.float32)
+
+        added_ids = [doc_ids[i] for i in missing]
+        for j, i in enumerate(missing):
+            row_of[keys[i]] = len(self.ids) + j
+
+        if missing or removed_ids or doc_ids != self.ids:
+            combined = np.concatenate([self.vectors, new_vectors]) if len(self.ids) else new_vectors
+            rows = [row_of[key] for key in keys]
+            self.vectors = combined[rows] if rows else np.empty((0, self.dim), dtype=np.float32)
+            self.ids = doc_ids
+            self.hashes = doc_hashes
+            self.save()
+            print(f"Vectors saved to {self.vectors_file} (+{len(added_ids)} / -{len(removed_ids)})")
+
+        return self.vectors, added_ids, removed_ids
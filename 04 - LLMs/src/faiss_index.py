@@ -1,25 +1,469 @@
+import json
+import os
 import faiss
 import numpy as np
+from doc_store import DocStore
+from metadata_index import MetadataIndex
+from micro_batcher import MicroBatcher
+
+# Read flags tried in order when opening an exported index: map flat codes (faiss builds with
+# IO_FLAG_MMAP_IFC) and IVF inverted lists instead of reading them into RAM; IVF indexes reject
+# the combined flags, so fall back to the IVF-only flag and finally to a plain read
+MMAP_FLAGS = [
+    faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0),
+    faiss.IO_FLAG_MMAP,
+    0,
+]
+
+# What the index keeps per vector. Compact storages search their codes for rescore_factor * k candidates,
+# which are then rescored exactly against the full-precision vectors:
+#   float32  the vectors themselves (no rescoring)
+#   float16  half-precision scalar quantizer, 2 bytes per dimension
+#   int8     8-bit scalar quantizer trained per dimension, 1 byte per dimension
+#   binary   sign bits searched by Hamming distance, 1 bit per dimension (Flat index spec only)
+STORAGES = {"float32": None, "float16": "SQfp16", "int8": "SQ8", "binary": None}
+
+
+def storage_spec(index_spec, storage):
+    """index_spec with its flat codes replaced by storage's scalar quantizer, e.g. ("IVF1024,Flat", "int8")
+    gives "IVF1024,SQ8" and ("HNSW32", "float16") gives "HNSW32,SQfp16"."""
+    if storage not in STORAGES:
+        raise ValueError(f"Unknown storage {storage}, expected one of {list(STORAGES)}")
+    code = STORAGES[storage]
+    if code is None:
+        return index_spec
+    if index_spec == "Flat":
+        return code
+    if index_spec.endswith(",Flat"):
+        return index_spec[:-len("Flat")] + code
+    if index_spec.startswith("HNSW") and "," not in index_spec:
+        return f"{index_spec},{code}"
+    raise ValueError(f"Storage {storage} needs flat codes, {index_spec} already compresses them")
+
+
+def binary_codes(vectors):
+    """One sign bit per dimension, packed 8 per byte."""
+    return np.packbits(vectors > 0, axis=1)
+
+
+def search_params(index, selector):
+    """Search parameters carrying selector, keeping the index's current nprobe / efSearch."""
+    if isinstance(index, faiss.IndexBinary):
+        return faiss.SearchParameters(sel=selector)
+    ivf = faiss.try_extract_index_ivf(index)
+    base = index
+    if isinstance(base, faiss.IndexIDMap2):
+        base = faiss.downcast_index(base.index)
+    if ivf is not None:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    elif isinstance(base, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    if isinstance(index, faiss.IndexPreTransform):
+        params = faiss.SearchParametersPreTransform(index_params=params)
+    return params
+
+
+def extract_ivf(index):
+    """The IVF part of a float index, None for other index types and binary ones."""
+    if isinstance(index, faiss.IndexBinary):
+        return None
+    return faiss.try_extract_index_ivf(index)
+
+
+def extract_hnsw(index):
+    """The HNSW graph index inside index (itself or wrapped), None for other index types."""
+    while index is not None:
+        index = faiss.downcast_IndexBinary(index) if isinstance(index, faiss.IndexBinary) else faiss.downcast_index(index)
+        if "HNSW" in type(index).__name__:
+            return index
+        # IndexIDMap2 and IndexPreTransform wrap the index that holds the vectors
+        index = getattr(index, "index", None)
+    return None
+
+
+def supports_removal(index):
+    """False when index is an HNSW graph (or wraps one): HNSW cannot delete nodes, faiss raises on remove_ids."""
+    return extract_hnsw(index) is None
+
+
+def read_index(index_file):
+    """Reads an index with the first MMAP_FLAGS set it accepts."""
+    for flags in MMAP_FLAGS:
+        try:
+            return faiss.read_index(index_file, flags)
+        except RuntimeError:
+            if flags == MMAP_FLAGS[-1]:
+                raise
+
 
 class FAISSIndex:
-    def __init__(self, vectors: np.ndarray, docs: list):
-        self.docs = docs
-        self.vectors = vectors
+    INDEX_FILE = "index.faiss"
+    VECTORS_FILE = "vectors.npy"
+    STORAGE_FILE = "index.json"
+    ADD_BLOCK = 65_536
+
+    def __init__(self, vectors: np.ndarray, docs: list, index_spec="Flat", train_size=100_000,
+                 nprobe=None, ef_search=None, storage="float32", rescore_factor=4):
+        """index_spec is a faiss.index_factory string, e.g. "Flat", "IVF1024,Flat", "IVF1024,PQ64",
+        "HNSW32" or "OPQ64,IVF1024,PQ64". Trainable indexes are trained on a sample of vectors.
+
+        storage (see STORAGES) keeps compact codes in the index; vectors are then referenced, not copied,
+        for rescoring, so passing a memory-mapped matrix keeps the full-precision copy on disk."""
         self.dim = vectors.shape[1]
-        self.index = faiss.IndexFlatIP(self.dim)
-        faiss.normalize_L2(self.vectors)
-        self.index.add(self.vectors)
-
-    def retrieve(self, query_vec: np.ndarray, top_k=3):
-        if query_vec.ndim == 1:
-            query_vec = query_vec.reshape(1, -1)
-        query_vec = np.asarray(query_vec, dtype=np.float32)
+        self.index_spec = index_spec
+        self.storage = storage
+        self.rescore_factor = rescore_factor
+        base = self.build_index(vectors, index_spec, train_size, storage=storage)
+        # Docs are added and removed by a stable int64 id instead of row position. IVF indexes store ids
+        # natively; wrapping them in IndexIDMap2 breaks the id map on removal, since IVF does not renumber
+        if isinstance(base, faiss.IndexBinary):
+            self.index = faiss.IndexBinaryIDMap2(base)
+        elif extract_ivf(base) is not None:
+            self.index = base
+        else:
+            self.index = faiss.IndexIDMap2(base)
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
+        self.search_batcher = None
+        # Full-precision vectors for rescoring and score_ids, as (first internal id, matrix) segments:
+        # one per add_with_ids call with compact storage, or the exported vectors.npy in open()
+        self.vector_segments = []
+        self.cluster_of = None
+        self.metadata = MetadataIndex()
+        self.docs = {}
+        self.id_of = {}
+        self._next_id = 0
+        self.add_with_ids(vectors, docs)
+
+    @staticmethod
+    def build_index(vectors: np.ndarray, index_spec="Flat", train_size=100_000, seed=0, storage="float32"):
+        """Returns an empty inner-product index for index_spec, trained on up to train_size normalized vectors."""
+        if storage == "binary":
+            if index_spec != "Flat":
+                raise ValueError(f"Binary storage only supports the Flat index spec, not {index_spec}")
+            return faiss.IndexBinaryFlat(vectors.shape[1])
+        index_spec = storage_spec(index_spec, storage)
+        index = faiss.index_factory(vectors.shape[1], index_spec, faiss.METRIC_INNER_PRODUCT)
+        if not index.is_trained:
+            rng = np.random.default_rng(seed)
+            n = vectors.shape[0]
+            rows = np.sort(rng.choice(n, size=min(n, train_size), replace=False))
+            sample = np.array(vectors[rows], dtype=np.float32)
+            faiss.normalize_L2(sample)
+            print(f"Training {index_spec} index on {len(sample)} vectors...")
+            index.train(sample)
+        return index
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Runtime recall/latency knobs: nprobe for IVF indexes, efSearch for HNSW ones. A knob the index type
+        does not have is ignored, so the same settings can be passed whatever the index spec is."""
+        params = faiss.ParameterSpace()
+        if nprobe is not None and extract_ivf(self.index) is not None:
+            params.set_index_parameter(self.index, "nprobe", nprobe)
+        if ef_search is not None and extract_hnsw(self.index) is not None:
+            params.set_index_parameter(self.index, "efSearch", ef_search)
+
+    @classmethod
+    def export(cls, folder, vectors: np.ndarray, docs: list, index_spec="Flat", train_size=100_000,
+               storage="float32"):
+        """Writes pre-normalized vectors, an index whose ids are row numbers and a row-addressable DocStore.
+
+        vectors.npy stays full precision whatever the storage, it is the rescoring file of compact indexes."""
+        os.makedirs(folder, exist_ok=True)
+        vectors = np.array(vectors, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        np.save(os.path.join(folder, cls.VECTORS_FILE), vectors)
+        DocStore.write(folder, docs)
+        MetadataIndex.build(docs).save(folder)
+        with open(os.path.join(folder, cls.STORAGE_FILE), "w") as f:
+            json.dump({"storage": storage}, f)
+
+        # The index file is written last, its presence marks a complete export
+        index = cls.build_index(vectors, index_spec, train_size, storage=storage)
+        if storage == "binary":
+            index.add(binary_codes(vectors))
+            faiss.write_index_binary(index, os.path.join(folder, cls.INDEX_FILE))
+        else:
+            index.add(vectors)
+            faiss.write_index(index, os.path.join(folder, cls.INDEX_FILE))
+        print(f"Serving files exported to {folder}")
+
+    @classmethod
+    def open(cls, folder, nprobe=None, ef_search=None, rescore_factor=4):
+        """Opens an exported folder read-only; vectors and docs stay on disk and are shared through the page cache."""
+        self = cls.__new__(cls)
+        try:
+            with open(os.path.join(folder, cls.STORAGE_FILE), "r") as f:
+                self.storage = json.load(f)["storage"]
+        except FileNotFoundError:
+            self.storage = "float32"
+        self.rescore_factor = rescore_factor
+        index_file = os.path.join(folder, cls.INDEX_FILE)
+        self.index = faiss.read_index_binary(index_file) if self.storage == "binary" else read_index(index_file)
+        self.dim = self.index.d
+        self.index_spec = None
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
+        self.search_batcher = None
+        # Normalized full-precision vectors: rescoring of compact codes, and scoring candidates that did not
+        # come from this index
+        self.vector_segments = [(0, np.load(os.path.join(folder, cls.VECTORS_FILE), mmap_mode="r"))]
+        self.docs = DocStore(folder)
+        self.cluster_of = None
+        try:
+            self.metadata = MetadataIndex.load(folder)
+        except FileNotFoundError:
+            print(f"No metadata columns in {folder}, building them from the doc store...")
+            self.metadata = MetadataIndex.build(list(self.docs))
+        self.id_of = {doc_id: row for row, doc_id in enumerate(self.docs.ids)}
+        self._next_id = len(self.docs)
+        return self
+
+    def add_with_ids(self, vectors: np.ndarray, docs: list):
+        if len(docs) == 0:
+            return
+        if vectors.shape[0] != len(docs):
+            raise ValueError(f"Got {vectors.shape[0]} vectors for {len(docs)} docs")
+
+        # Replace docs that are already indexed, e.g. patents whose text changed
+        self.remove_ids([doc["id"] for doc in docs if doc["id"] in self.id_of])
+
+        ids = np.arange(self._next_id, self._next_id + len(docs), dtype=np.int64)
+        self._next_id += len(docs)
+
+        # Normalized and added block by block, so a memory-mapped matrix is never read into RAM at once
+        for start in range(0, len(docs), self.ADD_BLOCK):
+            block = np.array(vectors[start:start + self.ADD_BLOCK], dtype=np.float32)
+            faiss.normalize_L2(block)
+            if self.storage == "binary":
+                block = binary_codes(block)
+            self.index.add_with_ids(block, ids[start:start + self.ADD_BLOCK])
+        if self.storage != "float32":
+            self.vector_segments.append((int(ids[0]), vectors))
+        self.metadata.add(ids, docs)
+        for internal_id, doc in zip(ids.tolist(), docs):
+            self.docs[internal_id] = doc
+            self.id_of[doc["id"]] = internal_id
+
+    @property
+    def supports_removal(self):
+        return supports_removal(self.index)
+
+    def remove_ids(self, doc_ids):
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id in self.id_of]
+        if not doc_ids:
+            return 0
+        if not self.supports_removal:
+            raise ValueError(f"{self.index_spec or 'This'} index cannot remove or replace docs in place "
+                             f"({len(doc_ids)} requested): rebuild the index instead")
+        internal_ids = [self.id_of.pop(doc_id) for doc_id in doc_ids]
+        for internal_id in internal_ids:
+            del self.docs[internal_id]
+        ivf = extract_ivf(self.index)
+        if ivf is not None and ivf.direct_map.type != faiss.DirectMap.NoMap:
+            # The hashtable direct map only supports removal by IDSelectorArray;
+            # drop it here, _reconstruct rebuilds it on the next use
+            ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+        return self.index.remove_ids(np.asarray(internal_ids, dtype=np.int64))
+
+    def get_doc(self, doc_id):
+        return self.docs[self.id_of[doc_id]]
+
+    def _reconstruct(self, internal_ids):
+        """Normalized full-precision vectors of internal_ids."""
+        if self.vector_segments:
+            starts = np.array([first for first, _ in self.vector_segments], dtype=np.int64)
+            segment_of = np.searchsorted(starts, internal_ids, side="right") - 1
+            vectors = np.empty((len(internal_ids), self.dim), dtype=np.float32)
+            for segment in np.unique(segment_of):
+                rows = segment_of == segment
+                first, segment_vectors = self.vector_segments[segment]
+                vectors[rows] = segment_vectors[internal_ids[rows] - first]
+            faiss.normalize_L2(vectors)
+            return vectors
+        try:
+            return self.index.reconstruct_batch(internal_ids)
+        except RuntimeError:
+            # IVF indexes need a direct map to reconstruct; the hashtable kind still supports remove_ids
+            ivf = faiss.extract_index_ivf(self.index)
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+            return self.index.reconstruct_batch(internal_ids)
+
+    def score_ids(self, query_vec: np.ndarray, doc_ids):
+        """Cosine similarity between one query and the given indexed docs, without searching the index."""
+        if len(doc_ids) == 0:
+            return np.zeros(0, dtype=np.float32)
+        query_vec = np.array(query_vec, dtype=np.float32).reshape(1, -1)
         faiss.normalize_L2(query_vec)
-        D, I = self.index.search(query_vec, top_k)
-        results = []
-        for j, i in enumerate(I[0]):
-            if i != -1:
-                doc = self.docs[i].copy()
-                doc["score"] = float(D[0][j])
-                results.append(doc)
-        return results
+        internal_ids = np.asarray([self.id_of[doc_id] for doc_id in doc_ids], dtype=np.int64)
+        return self._reconstruct(internal_ids) @ query_vec[0]
+
+    def set_duplicates(self, clusters):
+        """Collapses each near-duplicate cluster (duplicate_index.DuplicateClusters) to its best hit; None turns it off.
+
+        Docs added after the clusters were built count as having no duplicate."""
+        if clusters is None:
+            self.cluster_of = None
+            return
+        cluster_of = np.full(self._next_id, -1, dtype=np.int32)
+        for row in np.flatnonzero(clusters.cluster >= 0):
+            internal_id = self.id_of.get(clusters.ids[row])
+            if internal_id is not None:
+                cluster_of[internal_id] = clusters.cluster[row]
+        self.cluster_of = cluster_of
+
+    def _clusters(self, internal_ids):
+        internal_ids = np.asarray(internal_ids, dtype=np.int64)
+        clusters = np.full(len(internal_ids), -1, dtype=np.int32)
+        known = (internal_ids >= 0) & (internal_ids < len(self.cluster_of))
+        clusters[known] = self.cluster_of[internal_ids[known]]
+        return clusters
+
+    def enable_micro_batching(self, max_batch=32, max_wait_ms=2.0):
+        """Merges concurrent retrieve_batch calls into one index.search (serving path)."""
+        self.search_batcher = MicroBatcher(
+            self._search_micro_batch, max_batch=max_batch, max_wait_ms=max_wait_ms, name="search-batcher"
+        )
+
+    def close(self):
+        """Stops the search batcher and unmaps the doc store, once no request uses this index any more."""
+        if self.search_batcher is not None:
+            self.search_batcher.stop()
+        if isinstance(self.docs, DocStore):
+            self.docs.close()
+
+    def _search_micro_batch(self, items):
+        # Callers may ask for different k: search with the largest and cut per query
+        k = max(top_k for _, top_k, _ in items)
+        queries = np.stack([vec for vec, _, _ in items])
+        min_scores = [min_score for _, _, min_score in items]
+        batch_results = self._search(queries, k, min_score=min_scores)
+        return [results[:top_k] for results, (_, top_k, _) in zip(batch_results, items)]
+
+    def retrieve_batch(self, query_vecs: np.ndarray, top_k=3, filters=None, min_score=None):
+        """Searches an (N, d) matrix of queries in one call and returns one result list per query.
+
+        filters (see MetadataIndex.select) restrict the search itself to the matching docs;
+        hits scoring under min_score are dropped before their doc is read."""
+        if query_vecs.ndim == 1:
+            query_vecs = query_vecs.reshape(1, -1)
+        allowed = self.metadata.select(filters) if filters else None
+        if allowed is not None:
+            # Each filter has its own selector, so filtered searches do not go through the batcher
+            return self._search(query_vecs, top_k, allowed, min_score)
+        if self.search_batcher is not None:
+            return self.search_batcher.submit_many([(vec, top_k, min_score) for vec in query_vecs])
+        return self._search(query_vecs, top_k, min_score=min_score)
+
+    def _params_for(self, allowed):
+        """(params, selector) for a search restricted to allowed ids; the selector must outlive the search."""
+        if allowed is None:
+            return None, None
+        selector = faiss.IDSelectorBatch(allowed)
+        return search_params(self.index, selector), selector
+
+    def _hit(self, internal_id, score):
+        doc = self.docs[int(internal_id)].copy()
+        doc["score"] = float(score)
+        return doc
+
+    def _index_search(self, query_vecs, k, params=None):
+        """index.search for normalized queries, with compact storage rescored exactly: the top
+        rescore_factor * k candidates by code are reordered by their full-precision cosine similarity."""
+        if self.storage == "float32":
+            return self.index.search(query_vecs, k, params=params)
+        codes = binary_codes(query_vecs) if self.storage == "binary" else query_vecs
+        _, candidates = self.index.search(codes, k * self.rescore_factor, params=params)
+
+        D = np.full(candidates.shape, -np.inf, dtype=np.float32)
+        for q in range(len(query_vecs)):
+            found = candidates[q] != -1
+            D[q, found] = self._reconstruct(candidates[q][found]) @ query_vecs[q]
+        order = np.argsort(-D, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, order, axis=1), np.take_along_axis(candidates, order, axis=1)
+
+    def _search(self, query_vecs: np.ndarray, top_k, allowed=None, min_score=None):
+        query_vecs = np.array(query_vecs, dtype=np.float32)
+        faiss.normalize_L2(query_vecs)
+        if allowed is not None and len(allowed) == 0:
+            return [[] for _ in query_vecs]
+        params, selector = self._params_for(allowed)
+        # With duplicate clusters, search twice as deep so collapsed hits still leave top_k results
+        k = top_k if self.cluster_of is None else top_k * 2
+        D, I = self._index_search(query_vecs, k, params=params)
+
+        if not isinstance(min_score, list):
+            min_score = [min_score] * len(query_vecs)
+        batch_results = []
+        for q in range(len(query_vecs)):
+            clusters = self._clusters(I[q]) if self.cluster_of is not None else None
+            seen = set()
+            # Hits come best first: stop at the first one under min_score instead of copying it
+            results = []
+            for j, i in enumerate(I[q]):
+                if i == -1 or (min_score[q] is not None and D[q][j] < min_score[q]) or len(results) == top_k:
+                    break
+                if clusters is not None and clusters[j] >= 0:
+                    # A better-scoring member of this cluster is already in the results
+                    if clusters[j] in seen:
+                        continue
+                    seen.add(clusters[j])
+                results.append(self._hit(i, D[q][j]))
+            batch_results.append(results)
+        return batch_results
+
+    def range_retrieve_batch(self, query_vecs: np.ndarray, min_score, max_results=20, offset=0,
+                             filters=None, max_candidates=1000):
+        """Every doc scoring at least min_score, best first, paginated.
+
+        Returns one (docs, total) pair per query: docs is the page [offset, offset + max_results) and total the
+        number of docs over the threshold, capped at max_candidates. Only the docs of the page are read."""
+        if query_vecs.ndim == 1:
+            query_vecs = query_vecs.reshape(1, -1)
+        query_vecs = np.array(query_vecs, dtype=np.float32)
+        faiss.normalize_L2(query_vecs)
+        allowed = self.metadata.select(filters) if filters else None
+        if allowed is not None and len(allowed) == 0:
+            return [([], 0) for _ in query_vecs]
+        params, selector = self._params_for(allowed)
+
+        try:
+            if self.storage != "float32":
+                # Range search over codes would threshold approximate scores
+                raise RuntimeError(f"No exact range search over {self.storage} codes")
+            lims, D, I = self.index.range_search(query_vecs, min_score, params=params)
+            hits = [(D[lims[q]:lims[q + 1]], I[lims[q]:lims[q + 1]]) for q in range(len(query_vecs))]
+        except RuntimeError:
+            # Index types without range search: grow k until the last hit falls under the threshold
+            hits = self._expanding_search(query_vecs, min_score, offset + max_results, max_candidates, params)
+
+        batch_results = []
+        for scores, ids in hits:
+            order = np.argsort(-scores, kind="stable")
+            if self.cluster_of is not None:
+                # Keep the best hit of each duplicate cluster
+                clusters = self._clusters(ids[order])
+                keep = clusters < 0
+                keep[np.unique(clusters, return_index=True)[1]] = True
+                order = order[keep]
+            order = order[:max_candidates]
+            page = order[offset:offset + max_results]
+            batch_results.append(([self._hit(ids[j], scores[j]) for j in page], len(order)))
+        return batch_results
+
+    def _expanding_search(self, query_vecs, min_score, k, max_candidates, params):
+        k = max(min(k, max_candidates), 1)
+        while True:
+            D, I = self._index_search(query_vecs, k, params=params)
+            exhausted = (I[:, -1] == -1) | (D[:, -1] < min_score)
+            if exhausted.all() or k >= max_candidates or k >= self.index.ntotal:
+                break
+            k = min(k * 2, max_candidates)
+        hits = []
+        for q in range(len(query_vecs)):
+            keep = (I[q] != -1) & (D[q] >= min_score)
+            hits.append((D[q][keep], I[q][keep]))
+        return hits
+
+    def retrieve(self, query_vec: np.ndarray, top_k=3, filters=None):
+        return self.retrieve_batch(query_vec, top_k=top_k, filters=filters)[0]
@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from bm25_index import BM25Index
+from duplicate_index import DuplicateClusters
+from faiss_index import STORAGES, FAISSIndex
+from sentence_vectors import SentenceVectors
+
+# A bundle is a versioned folder written once by the offline build and only ever opened read-only:
+#   {bundles_dir}/{version}/  index.faiss, vectors.npy, docs.bin, docs.idx.npy, ids.json, manifest.json
+#                             index.json (storage of the index codes; vectors.npy is their rescoring file)
+#                             metadata.npz, metadata.json (filter columns)
+#                             and the BM25 index (bm25.json, offsets.npy, rows.npy, weights.npy)
+#                             duplicates.npz, duplicates.json (near-duplicate clusters, when built with them)
+#                             sentence_vectors.f16, sentence_offsets.npy, sentences.json (dense context packing)
+#   {bundles_dir}/CURRENT     name of the version the server should serve
+# Publishing a version is a single os.replace of CURRENT, so readers never see a half-written bundle.
+
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT"
+# The dataset the server indexed itself before bundles: data/ at the repository root
+DEFAULT_DATASET_PATH = Path(__file__).resolve().parents[2] / "data"
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_bundle(bundles_dir, vectors, docs, model_name, index_spec="Flat", publish=True, storage="float32",
+                 dedup_threshold=None, sentence_encode=None):
+    """Writes a new bundle version and, when publish is set, makes it the current one.
+
+    sentence_encode (texts -> vectors) adds the sentence vectors dense context packing scores with."""
+    os.makedirs(bundles_dir, exist_ok=True)
+    version = time.strftime("v%Y%m%d-%H%M%S")
+    suffix = 1
+    while os.path.exists(os.path.join(bundles_dir, version)):
+        version = f"{time.strftime('v%Y%m%d-%H%M%S')}-{suffix}"
+        suffix += 1
+    tmp_dir = os.path.join(bundles_dir, f".building-{version}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    FAISSIndex.export(tmp_dir, vectors, docs, index_spec=index_spec, storage=storage)
+    BM25Index.build(docs).save(tmp_dir)
+    if dedup_threshold is not None:
+        DuplicateClusters.build([doc["id"] for doc in docs], vectors, threshold=dedup_threshold).save(tmp_dir)
+    if sentence_encode is not None:
+        SentenceVectors.build(tmp_dir, docs, sentence_encode)
+    files = sorted(name for name in os.listdir(tmp_dir))
+    manifest = {
+        "version": version,
+        "model_name": model_name,
+        "dim": int(vectors.shape[1]),
+        "count": len(docs),
+        "index_spec": index_spec,
+        "storage": storage,
+        "dedup_threshold": dedup_threshold,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": {name: _sha256(os.path.join(tmp_dir, name)) for name in files},
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    bundle_dir = os.path.join(bundles_dir, version)
+    os.rename(tmp_dir, bundle_dir)
+    print(f"Bundle {version} built in {bundle_dir}")
+
+    if publish:
+        publish_version(bundles_dir, version)
+    return version
+
+
+def publish_version(bundles_dir, version):
+    tmp_file = os.path.join(bundles_dir, f"{CURRENT_FILE}.tmp")
+    with open(tmp_file, "w") as f:
+        f.write(version)
+    os.replace(tmp_file, os.path.join(bundles_dir, CURRENT_FILE))
+    print(f"Bundle {version} published")
+
+
+def current_version(bundles_dir):
+    try:
+        with open(os.path.join(bundles_dir, CURRENT_FILE), "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def verify_bundle(bundle_dir, manifest):
+    for name, checksum in manifest["files"].items():
+        if _sha256(os.path.join(bundle_dir, name)) != checksum:
+            raise ValueError(f"Checksum mismatch for {name} in {bundle_dir}")
+
+
+def open_bundle(bundles_dir, version=None, model_name=None, verify=False, nprobe=None, ef_search=None):
+    """Opens a bundle read-only (the current one by default). Returns (FAISSIndex, manifest)."""
+    version = version or current_version(bundles_dir)
+    if version is None:
+        raise FileNotFoundError(f"No bundle published in {bundles_dir}")
+
+    bundle_dir = os.path.join(bundles_dir, version)
+    with open(os.path.join(bundle_dir, MANIFEST_FILE), "r") as f:
+        manifest = json.load(f)
+
+    if model_name is not None and manifest["model_name"] != model_name:
+        raise ValueError(f"Bundle {version} was built with {manifest['model_name']}, not {model_name}")
+    if verify:
+        verify_bundle(bundle_dir, manifest)
+
+    faiss_index = FAISSIndex.open(bundle_dir, nprobe=nprobe, ef_search=ef_search)
+    if faiss_index.dim != manifest["dim"] or len(faiss_index.docs) != manifest["count"]:
+        raise ValueError(f"Bundle {version} does not match its manifest")
+    if manifest.get("dedup_threshold") is not None:
+        faiss_index.set_duplicates(DuplicateClusters.load(bundle_dir))
+    return faiss_index, manifest
+
+
+def open_sparse_index(bundles_dir, version):
+    """The bundle's BM25 index, or None for bundles built before it was added."""
+    try:
+        return BM25Index.load(os.path.join(bundles_dir, version))
+    except FileNotFoundError:
+        return None
+
+
+def open_sentence_vectors(bundles_dir, version):
+    """The bundle's sentence vectors, or None for bundles built without them."""
+    try:
+        return SentenceVectors(os.path.join(bundles_dir, version))
+    except FileNotFoundError:
+        return None
+
+
+def bundles_dir_for(cache_dir, dataset_tag, model_tag):
+    return os.path.join(cache_dir, f"bundles_{dataset_tag}_{model_tag}")
+
+
+def main():
+    from dotenv import load_dotenv
+    from data_handler import DataHandler
+    from onnx_encoder import BACKENDS
+    from vectorizer import Vectorizer
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Build and publish a serving bundle")
+    parser.add_argument("--dataset-path", default=str(DEFAULT_DATASET_PATH),
+                        help="Folder of patent JSON files (default: data/ at the repository root)")
+    parser.add_argument("--dataset-tag", default="2016")
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--index-spec", default="Flat")
+    parser.add_argument("--storage", default="float32", choices=list(STORAGES))
+    parser.add_argument("--encoder-backend", default="torch", choices=list(BACKENDS))
+    parser.add_argument("--encoder-threads", type=int, default=None)
+    parser.add_argument("--encode-processes", type=int, default=1)
+    parser.add_argument("--dedup-threshold", type=float, default=None,
+                        help="Collapse patents whose vectors are at least this cosine-similar")
+    parser.add_argument("--context-scoring", default="dense", choices=["dense", "lexical"],
+                        help="dense also encodes every excerpt sentence so prompts are packed by cosine")
+    parser.add_argument("--no-publish", action="store_true")
+    args = parser.parse_args()
+    if not os.path.isdir(args.dataset_path):
+        parser.error(f"--dataset-path {args.dataset_path} is not a folder of patent JSON files")
+
+    data_handler = DataHandler(args.dataset_path)
+    texts, docs = data_handler.load_texts(
+        dataset_tag=args.dataset_tag,
+        ner_model_name=data_handler.get_ner_model_name(),
+        batched=True
+    )
+
+    vectorizer = Vectorizer(model_name=args.model, backend=args.encoder_backend, threads=args.encoder_threads)
+    vectors, docs = vectorizer.compute_vectors_and_metadata(
+        texts, docs, args.dataset_tag, storage=args.storage, processes=args.encode_processes
+    )
+
+    sentence_encode = None
+    if args.context_scoring == "dense":
+        sentence_encode = lambda texts: vectorizer.encode_texts(texts, show_progress_bar=False)
+
+    CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+    bundles_dir = bundles_dir_for(CACHE_DIR, args.dataset_tag, vectorizer.get_model_tag())
+    build_bundle(bundles_dir, vectors, docs, args.model, index_spec=args.index_spec, publish=not args.no_publish,
+                 storage=args.storage, dedup_threshold=args.dedup_threshold,
+                 sentence_encode=sentence_encode)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
 class LLM:
     def __init__(self, client, model):
         self.client = client
@@ -8,4 +12,95 @@ class LLM:
 
     def generate_text(self, prompt):
         response = self.generate_content(prompt)
-        return response.candidates[0].content.parts[0].text
\ No newline at end of file
+        return response.candidates[0].content.parts[0].text
+
+    async def generate_text_async(self, prompt):
+        # genai clients expose a native async API under .aio; anything else runs in a thread
+        aio = getattr(self.client, "aio", None)
+        if aio is None:
+            return await asyncio.to_thread(self.generate_text, prompt)
+        response = await aio.models.generate_content(model=self.model, contents=prompt)
+        return response.candidates[0].content.parts[0].text
+
+    def generate_stream(self, prompt):
+        """Yields text chunks as the model produces them. Closing the generator stops the stream."""
+        stream = self.client.models.generate_content_stream(model=self.model, contents=prompt)
+        try:
+            for chunk in stream:
+                if chunk.text:
+                    yield chunk.text
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+
+    async def generate_stream_async(self, prompt):
+        """Async generate_stream. Closing it (e.g. on client disconnect) cancels the upstream request."""
+        aio = getattr(self.client, "aio", None)
+        if aio is None:
+            chunks = self.generate_stream(prompt)
+            pending = None
+            try:
+                while True:
+                    # Shielded so a cancelled wait (e.g. a timeout) leaves the task tracking the worker thread
+                    pending = asyncio.ensure_future(asyncio.to_thread(next, chunks, None))
+                    chunk = await asyncio.shield(pending)
+                    if chunk is None:
+                        break
+                    yield chunk
+            finally:
+                if pending is not None and not pending.done():
+                    # The thread is still inside next(chunks), closing now would raise "generator already
+                    # executing": close it once that call returns
+                    pending.add_done_callback(lambda done: _close_after(done, chunks))
+                else:
+                    chunks.close()
+            return
+
+        stream = await aio.models.generate_content_stream(model=self.model, contents=prompt)
+        try:
+            async for chunk in stream:
+                if chunk.text:
+                    yield chunk.text
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+def _close_after(done, chunks):
+    if not done.cancelled():
+        done.exception()  # retrieved so a failed chunk is not reported as never retrieved
+    chunks.close()
+
+
+def _response(text):
+    part = SimpleNamespace(text=text)
+    return SimpleNamespace(text=text, candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+class StubClient:
+    """Offline stand-in for genai.Client: answers every prompt with a fixed text and counts the calls.
+
+    generate_content_stream yields the answer word by word, waiting chunk_delay seconds between chunks,
+    and records how many chunks were actually sent so cancellation can be checked.
+    """
+
+    def __init__(self, answer="stub answer", chunk_delay=0.0):
+        self.answer = answer
+        self.chunk_delay = chunk_delay
+        self.calls = 0
+        self.chunks_sent = 0
+        self.models = self
+
+    def generate_content(self, model, contents):
+        self.calls += 1
+        return _response(self.answer)
+
+    def generate_content_stream(self, model, contents):
+        self.calls += 1
+        for i, word in enumerate(self.answer.split(" ")):
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            self.chunks_sent += 1
+            yield _response(word if i == 0 else " " + word)
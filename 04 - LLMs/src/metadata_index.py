@@ -0,0 +1,160 @@
+import json
+import os
+import numpy as np
+
+# Columnar doc attributes addressed by the FAISS id of each doc:
+#   filing_day / issue_day   int32 YYYYMMDD (0 when missing), so date ranges are integer comparisons
+#   cpc                      int32 position in self.cpc_labels (-1 when missing)
+# plus per-year and per-CPC-subclass id lists, so a filter starts from the matching partitions
+# instead of scanning every doc.
+
+DATE_FIELDS = {"filing_date": "filing_day", "patent_issue_date": "issue_day"}
+
+
+def parse_day(value, upper=False):
+    """'2016-01-21', '20160121', '2016-06' or '2016' to an int YYYYMMDD, 0 when missing.
+
+    Partial dates expand to the start of the period, or to its end when upper is set."""
+    if not value:
+        return 0
+    digits = str(value).replace("-", "").replace("/", "")[:8]
+    if not digits.isdigit():
+        return 0
+    return int(digits.ljust(8, "9" if upper else "0"))
+
+
+class MetadataIndex:
+    COLUMNS_FILE = "metadata.npz"
+    LABELS_FILE = "metadata.json"
+
+    def __init__(self):
+        self.filing_day = np.zeros(0, dtype=np.int32)
+        self.issue_day = np.zeros(0, dtype=np.int32)
+        self.cpc = np.zeros(0, dtype=np.int32)
+        self.cpc_labels = []
+        self._label_code = {}
+        self._by_year = None
+        self._by_subclass = None
+
+    def add(self, ids, docs):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        size = int(ids.max()) + 1
+        if size > len(self.cpc):
+            grow = size - len(self.cpc)
+            self.filing_day = np.concatenate([self.filing_day, np.zeros(grow, dtype=np.int32)])
+            self.issue_day = np.concatenate([self.issue_day, np.zeros(grow, dtype=np.int32)])
+            self.cpc = np.concatenate([self.cpc, np.full(grow, -1, dtype=np.int32)])
+
+        for i, doc in zip(ids.tolist(), docs):
+            metadata = doc.get("metadata", {})
+            self.filing_day[i] = parse_day(metadata.get("filing_date"))
+            self.issue_day[i] = parse_day(metadata.get("patent_issue_date"))
+            self.cpc[i] = self._code(metadata.get("main_cpc_label"))
+        # Partitions are rebuilt lazily on the next filtered search
+        self._by_year = None
+        self._by_subclass = None
+
+    def _code(self, label):
+        if not label:
+            return -1
+        code = self._label_code.get(label)
+        if code is None:
+            code = self._label_code[label] = len(self.cpc_labels)
+            self.cpc_labels.append(label)
+        return code
+
+    @staticmethod
+    def _group(keys):
+        """{key: sorted ids} for an int key per id, in one argsort."""
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(keys) else []
+        bounds = list(starts) + [len(keys)]
+        return {int(sorted_keys[s]): order[s:e].astype(np.int64) for s, e in zip(bounds[:-1], bounds[1:])}
+
+    def _partitions(self):
+        if self._by_year is None:
+            self._by_year = self._group(self.filing_day // 10000)
+            # Subclass ("H01M") of every label code, then one group-by over the cpc column
+            subclasses = sorted({label[:4] for label in self.cpc_labels})
+            subclass_code = {subclass: i for i, subclass in enumerate(subclasses)}
+            label_subclass = np.array([subclass_code[label[:4]] for label in self.cpc_labels] + [-1], dtype=np.int32)
+            groups = self._group(label_subclass[self.cpc])
+            self._by_subclass = {subclasses[code]: ids for code, ids in groups.items() if code >= 0}
+        return self._by_year, self._by_subclass
+
+    def select(self, filters):
+        """Sorted ids of the docs matching filters, or None when filters restrict nothing.
+
+        filters: {"cpc": ["H01M", "G06F16/24"], "date_from": "2016-01-01", "date_to": "2016-12-31",
+                  "date_field": "filing_date" | "patent_issue_date"}; CPC codes match by prefix.
+        """
+        if not filters:
+            return None
+        cpc_prefixes = [prefix.replace(" ", "").upper() for prefix in filters.get("cpc") or [] if prefix]
+        date_from = parse_day(filters.get("date_from"))
+        date_to = parse_day(filters.get("date_to"), upper=True)
+        if not (cpc_prefixes or date_from or date_to):
+            return None
+
+        by_year, by_subclass = self._partitions()
+        selected = None
+
+        if cpc_prefixes:
+            parts = []
+            for prefix in cpc_prefixes:
+                if len(prefix) >= 4:
+                    ids = by_subclass.get(prefix[:4], np.zeros(0, dtype=np.int64))
+                    if len(prefix) > 4:
+                        codes = [code for code, label in enumerate(self.cpc_labels) if label.startswith(prefix)]
+                        ids = ids[np.isin(self.cpc[ids], codes)]
+                else:
+                    # Section or class prefix ("H", "H01"): union of the matching subclasses
+                    matching = [group for subclass, group in by_subclass.items() if subclass.startswith(prefix)]
+                    ids = np.concatenate(matching) if matching else np.zeros(0, dtype=np.int64)
+                parts.append(ids)
+            selected = np.unique(np.concatenate(parts))
+
+        if date_from or date_to:
+            field = DATE_FIELDS.get(filters.get("date_field") or "filing_date")
+            if field is None:
+                raise ValueError(f"Unknown date_field {filters.get('date_field')}, expected one of {list(DATE_FIELDS)}")
+            days = getattr(self, field)
+            upper = date_to or 99991231
+            if field == "filing_day":
+                first_year, last_year = date_from // 10000, upper // 10000
+                years = [ids for year, ids in by_year.items() if year and first_year <= year <= last_year]
+                candidates = np.sort(np.concatenate(years)) if years else np.zeros(0, dtype=np.int64)
+            else:
+                candidates = np.flatnonzero(days).astype(np.int64)
+            candidates = candidates[(days[candidates] >= date_from) & (days[candidates] <= upper)]
+            selected = candidates if selected is None else np.intersect1d(selected, candidates, assume_unique=True)
+
+        return selected
+
+    @classmethod
+    def build(cls, docs):
+        """Index over docs addressed by row number, as in exported serving folders."""
+        index = cls()
+        index.add(np.arange(len(docs)), docs)
+        return index
+
+    def save(self, folder):
+        np.savez(os.path.join(folder, self.COLUMNS_FILE),
+                 filing_day=self.filing_day, issue_day=self.issue_day, cpc=self.cpc)
+        with open(os.path.join(folder, self.LABELS_FILE), "w") as f:
+            json.dump({"cpc_labels": self.cpc_labels}, f)
+
+    @classmethod
+    def load(cls, folder):
+        index = cls()
+        with np.load(os.path.join(folder, cls.COLUMNS_FILE)) as columns:
+            index.filing_day = columns["filing_day"]
+            index.issue_day = columns["issue_day"]
+            index.cpc = columns["cpc"]
+        with open(os.path.join(folder, cls.LABELS_FILE), "r") as f:
+            index.cpc_labels = json.load(f)["cpc_labels"]
+        index._label_code = {label: code for code, label in enumerate(index.cpc_labels)}
+        return index
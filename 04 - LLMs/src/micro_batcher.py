@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Queued by stop(): the worker finishes the items before it and exits
+_STOP = object()
+
+
+class MicroBatcher:
+    """Collects items submitted from many threads for up to max_wait_ms or max_batch items,
+    runs fn once on the whole list and hands each caller its own result.
+
+    fn takes a list of items and returns a list of results in the same order.
+    """
+
+    def __init__(self, fn, max_batch=32, max_wait_ms=5.0, name="micro-batcher"):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self.max_batch_seen = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+        self._stopped = False
+        self._worker = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._worker.start()
+
+    def submit_many(self, items):
+        """Blocks until every item has been processed, possibly batched with other callers' items."""
+        if self._stopped:
+            raise RuntimeError(f"{self._worker.name} is stopped")
+        futures = []
+        for item in items:
+            future = Future()
+            self._queue.put((item, future, time.monotonic()))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def submit(self, item):
+        return self.submit_many([item])[0]
+
+    def stop(self, timeout=None):
+        """Processes what is already queued, then ends the worker thread. Later submits raise RuntimeError."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(_STOP)
+        self._worker.join(timeout)
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        # Window closed: still take whatever is already queued
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._run(batch)
+            if stopping:
+                return
+
+    def _run(self, batch):
+        started = time.monotonic()
+        for _, _, enqueued in batch:
+            delay = started - enqueued
+            self.total_delay += delay
+            self.max_delay = max(self.max_delay, delay)
+        self.batches += 1
+        self.items += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+        try:
+            results = self.fn([item for item, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self):
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_seen,
+            "mean_queue_delay_ms": self.total_delay / self.items * 1000 if self.items else 0.0,
+            "max_queue_delay_ms": self.max_delay * 1000,
+        }
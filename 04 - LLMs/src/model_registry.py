@@ -0,0 +1,79 @@
+import threading
+
+# Process-wide registry: every encoder and spaCy pipeline is loaded once, on first use, and shared by
+# PatentRAGSystem, RAGService and BenchmarkSystem. Heavy libraries are only imported here, lazily.
+
+_models = {}
+_lock = threading.Lock()
+
+
+def _get_or_load(key, loader):
+    model = _models.get(key)
+    if model is not None:
+        return model
+    with _lock:
+        if key not in _models:
+            _models[key] = loader()
+        return _models[key]
+
+
+def default_device():
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def get_sentence_transformer(model_name, device=None, backend="torch", threads=None):
+    """backend is one of onnx_encoder.BACKENDS; the ONNX ones always run on CPU.
+
+    threads caps the encoder's CPU threads (torch.set_num_threads is process-wide)."""
+    if backend != "torch":
+        device = "cpu"
+    elif device is None:
+        device = default_device()
+
+    def load():
+        if backend != "torch":
+            import onnx_encoder
+            print(f"Loading sentence-transformer {model_name} with the {backend} backend")
+            return onnx_encoder.load(model_name, backend, threads=threads)
+
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        print(f"Loading sentence-transformer {model_name} on {device}")
+        return SentenceTransformer(model_name, device=device)
+
+    return _get_or_load(("sentence_transformer", model_name, device, backend, threads), load)
+
+
+def get_cross_encoder(model_name, device="cpu"):
+    def load():
+        from sentence_transformers import CrossEncoder
+        print(f"Loading cross-encoder {model_name} on {device}")
+        return CrossEncoder(model_name, device=device)
+
+    return _get_or_load(("cross_encoder", model_name, device), load)
+
+
+def get_spacy(name, prefer_gpu=False):
+    def load():
+        import spacy
+        if prefer_gpu:
+            spacy.prefer_gpu()
+        print(f"Loading spaCy pipeline {name}")
+        return spacy.load(name)
+
+    return _get_or_load(("spacy", name, prefer_gpu), load)
+
+
+def warm_up(encoders=(), spacy_pipelines=()):
+    """Loads the given models ahead of the first request."""
+    for model_name in encoders:
+        get_sentence_transformer(model_name)
+    for name in spacy_pipelines:
+        get_spacy(name)
+
+
+def loaded_models():
+    return [":".join(str(part) for part in key) for key in _models]
@@ -5,34 +5,54 @@ warnings.filterwarnings(
     category=UserWarning
 )
 import os
-import spacy
-from spacy.lang.en.stop_words import STOP_WORDS
+import model_registry
 
 class NERHandler:
+    # noun_chunks only needs the tagger and the parser
+    UNUSED_PIPES = ["ner", "lemmatizer"]
+    # Bump whenever extract_from_doc/clean_entities change, so cached entities get recomputed
+    CLEANING_VERSION = 1
+
     def __init__(self):
-        self.nlp = spacy.load("en_core_web_sm")
-        self.model_name = "sm"
-        hardware = os.getenv("HARDWARE", "CPU").upper()
-        if hardware == "GPU":
+        # The pipeline is loaded on first use, so a warm doc cache never pays for spaCy
+        self.hardware = os.getenv("HARDWARE", "CPU").upper()
+        self.model_name = "trf" if self.hardware == "GPU" else "sm"
+        self.device = "gpu" if self.hardware == "GPU" else "cpu"
+        self._nlp = None
+
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            self._nlp = self._load()
+        return self._nlp
+
+    def _load(self):
+        if self.hardware == "GPU":
             try:
-                spacy.prefer_gpu()
-                self.device = "gpu"
-                self.nlp = spacy.load("en_core_web_trf")
-                self.model_name = "trf"
-                spacy.prefer_gpu()
+                nlp = model_registry.get_spacy("en_core_web_trf", prefer_gpu=True)
                 print("NERHandler using GPU")
+                return nlp
             except Exception as e:
                 print(f"GPU not available for spacy, falling back to CPU: {e}")
                 self.device = "cpu"
-        else:
-            self.device = "cpu"
-            print("NERHandler using CPU")
-    
+                self.model_name = "sm"
+        print("NERHandler using CPU")
+        return model_registry.get_spacy("en_core_web_sm")
+
     def get_model_name(self):
+        if self.hardware == "GPU":
+            # The GPU pipeline may fall back to sm, which is only known once it is loaded
+            self.nlp
         return self.model_name
 
+    def get_cleaning_version(self):
+        return self.CLEANING_VERSION
+
     def extract_from_text(self, abstract, max_words=3):
         doc = self.nlp(abstract)
+        return self.extract_from_doc(doc, max_words)
+
+    def extract_from_doc(self, doc, max_words=3):
         candidates = set()
         for np in doc.noun_chunks:
             phrase = np.text.strip()
@@ -41,6 +61,7 @@ class NERHandler:
         return list(candidates)
     
     def clean_entities(self, entities):
+        from spacy.lang.en.stop_words import STOP_WORDS
         cleaned = []
         for ent in entities:
             text = ent.strip().lower()
@@ -71,4 +92,18 @@ class NERHandler:
     def extract_entities(self, text):
         raw_entities = self.extract_from_text(text)
         entities = self.clean_entities(raw_entities)
-        return entities
\ No newline at end of file
+        return entities
+
+    def pipe_entities(self, items, batch_size=64, n_process=1):
+        """Yields (entities, context) for an iterable of (text, context) tuples, in input order."""
+        disable = [name for name in self.UNUSED_PIPES if name in self.nlp.pipe_names]
+        docs = self.nlp.pipe(
+            items,
+            as_tuples=True,
+            batch_size=batch_size,
+            n_process=n_process,
+            disable=disable
+        )
+        for doc, context in docs:
+            raw_entities = self.extract_from_doc(doc)
+            yield self.clean_entities(raw_entities), context
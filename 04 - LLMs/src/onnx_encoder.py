@@ -0,0 +1,125 @@
+import json
+import os
+import platform
+import numpy as np
+
+# Encoder backends behind Vectorizer.encode_texts:
+#   torch      SentenceTransformer on PyTorch (default)
+#   onnx       the same model exported to ONNX and run by onnxruntime on CPU
+#   onnx-int8  the ONNX export with dynamically quantized int8 weights
+# The ONNX backends need optimum[onnxruntime] (pinned in requirements.txt). Exports are written once under
+# cache/onnx/ and, before first use, checked against the PyTorch vectors.
+BACKENDS = ("torch", "onnx", "onnx-int8")
+PARITY_FILE = "parity.json"
+PARITY_MIN_COSINE = 0.99
+PARITY_TEXTS = [
+    "A lithium-ion battery with a silicon-carbon composite anode and a nickel-rich cathode.",
+    "Method for training a neural network to detect anomalies in sensor data streams.",
+    "A wind turbine blade comprising a carbon fibre spar cap and a pitch control system.",
+    "Pharmaceutical composition for the treatment of type 2 diabetes comprising a GLP-1 agonist.",
+    "System and method for routing packets in a software-defined network based on latency.",
+    "An autonomous vehicle that fuses lidar and camera data to plan a trajectory.",
+    "Semiconductor device having a gate-all-around transistor and a backside power rail.",
+    "CRISPR-based gene editing of T cells for adoptive immunotherapy.",
+]
+
+
+def export_dir(model_name):
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(BASE_DIR, "cache", "onnx", model_name.replace("/", "__"))
+
+
+def default_quantization():
+    """onnxruntime quantization config for this CPU: arm64, avx512_vnni or avx2."""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            if "avx512_vnni" in f.read():
+                return "avx512_vnni"
+    except OSError:
+        pass
+    return "avx2"
+
+
+def onnx_file(backend, quantization=None):
+    if backend == "onnx":
+        return "onnx/model.onnx"
+    if backend == "onnx-int8":
+        return f"onnx/model_qint8_{quantization or default_quantization()}.onnx"
+    raise ValueError(f"Unknown encoder backend {backend}, expected one of {BACKENDS}")
+
+
+def export(model_name, backend="onnx", quantization=None, folder=None):
+    """Exports model_name to ONNX in folder (and its int8 variant for onnx-int8), once. Returns (folder, file)."""
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    folder = folder or export_dir(model_name)
+    file_name = onnx_file(backend, quantization)
+    if os.path.exists(os.path.join(folder, file_name)):
+        return folder, file_name
+
+    if not os.path.exists(os.path.join(folder, onnx_file("onnx"))):
+        print(f"Exporting {model_name} to ONNX in {folder}...")
+        # Models without an ONNX file on the hub are converted on load
+        SentenceTransformer(model_name, device="cpu", backend="onnx").save_pretrained(folder)
+    if backend == "onnx-int8":
+        print(f"Quantizing {model_name} to int8 ({quantization or default_quantization()})...")
+        model = SentenceTransformer(folder, device="cpu", backend="onnx")
+        export_dynamic_quantized_onnx_model(model, quantization or default_quantization(), folder)
+    return folder, file_name
+
+
+def cosine_parity(reference, candidate, texts=PARITY_TEXTS):
+    """Per-text cosine similarity between two encoders' vectors for texts."""
+    a = np.asarray(reference.encode(texts, convert_to_numpy=True, normalize_embeddings=True))
+    b = np.asarray(candidate.encode(texts, convert_to_numpy=True, normalize_embeddings=True))
+    return np.sum(a * b, axis=1)
+
+
+def check_parity(model_name, model, folder, file_name, min_cosine=PARITY_MIN_COSINE):
+    """Compares an exported model with the PyTorch one on PARITY_TEXTS; raises ValueError under min_cosine.
+
+    The result is recorded per file in folder/parity.json, so each export is checked once."""
+    parity_path = os.path.join(folder, PARITY_FILE)
+    try:
+        with open(parity_path, "r") as f:
+            checks = json.load(f)
+    except FileNotFoundError:
+        checks = {}
+
+    check = checks.get(file_name)
+    if check is None:
+        from sentence_transformers import SentenceTransformer
+        cosines = cosine_parity(SentenceTransformer(model_name, device="cpu"), model)
+        check = {"min_cosine": float(cosines.min()), "mean_cosine": float(cosines.mean()), "texts": len(cosines)}
+        checks[file_name] = check
+        with open(parity_path, "w") as f:
+            json.dump(checks, f, indent=2)
+        print(f"Parity {file_name} vs PyTorch: min cosine {check['min_cosine']:.4f}, "
+              f"mean {check['mean_cosine']:.4f}")
+
+    if check["min_cosine"] < min_cosine:
+        raise ValueError(f"{model_name} {file_name} drifts from PyTorch: min cosine {check['min_cosine']:.4f} "
+                         f"< {min_cosine}")
+    return check
+
+
+def load(model_name, backend="onnx", threads=None, quantization=None):
+    """SentenceTransformer running an ONNX export of model_name on onnxruntime's CPU provider.
+
+    threads sets onnxruntime's intra-op thread pool (default: all cores)."""
+    import onnxruntime
+    from sentence_transformers import SentenceTransformer
+
+    folder, file_name = export(model_name, backend, quantization)
+    options = onnxruntime.SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+    model = SentenceTransformer(
+        folder, device="cpu", backend="onnx",
+        model_kwargs={"file_name": file_name, "provider": "CPUExecutionProvider", "session_options": options}
+    )
+    check_parity(model_name, model, folder, file_name)
+    return model
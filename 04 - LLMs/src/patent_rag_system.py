@@ -3,20 +3,35 @@ from dotenv import load_dotenv
 from data_handler import DataHandler
 from vectorizer import Vectorizer
 from faiss_index import FAISSIndex
+from duplicate_index import DuplicateClusters
 from rag import PatentsRAG
-from google import genai
 from llm import LLM
 
 load_dotenv()
 
 class PatentRAGSystem:
     
-    def __init__(self, dataset_path, model_name = "all-MiniLM-L6-v2", dataset_tag = "sample", score_threshold = 0.1, batch_size = 64):
+    def __init__(self, dataset_path, model_name = "all-MiniLM-L6-v2", dataset_tag = "sample", score_threshold = 0.1, batch_size = 64,
+                 index_spec = "Flat", nprobe = None, ef_search = None, retrieval_mode = "dense", reranker = None,
+                 chunk_index_spec = "Flat", chunk_aggregation = "max", storage = "float32",
+                 encoder_backend = "torch", encoder_threads = None, encode_processes = 1, dedup_threshold = None,
+                 context_scoring = "dense"):
         self.dataset_path = dataset_path
         self.model_name = model_name
         self.dataset_tag = dataset_tag
         self.score_threshold = score_threshold
         self.batch_size = batch_size
+        self.encode_processes = encode_processes
+        self.index_spec = index_spec
+        # "float16", "int8" or "binary" keep compact codes in FAISS and rescore from the memory-mapped cache
+        self.storage = storage
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        # Chunks can be 50-100x the patents, so a compressed spec such as "IVF4096,PQ32" fits large datasets
+        self.chunk_index_spec = chunk_index_spec
+        self.chunk_aggregation = chunk_aggregation
+        # "dense" packs prompt sentences by cosine with the query (needs sentence vectors), "lexical" by BM25
+        self.context_scoring = context_scoring
         
         # Initialize components
         self.data_handler = DataHandler(dataset_path)
@@ -29,37 +44,147 @@ class PatentRAGSystem:
         )
         
         # Compute or load cached vectors
-        self.vectorizer = Vectorizer(model_name=model_name)
+        self.vectorizer = Vectorizer(model_name=model_name, backend=encoder_backend, threads=encoder_threads)
         self.vectors, self.docs = self.vectorizer.compute_vectors_and_metadata(
             texts, docs, dataset_tag,
-            batch_size=batch_size
+            batch_size=batch_size, storage=storage, processes=encode_processes
         )
         
         # Create FAISS index and RAG
-        self.faiss_index = FAISSIndex(self.vectors, self.docs)
-        self.rag = PatentsRAG(self.faiss_index, self.vectorizer, score_threshold=score_threshold)
-    
-    def query(self, query_text, top_k = 3):
-        prompt, retrieved_files = self.rag.generate_prompt(query_text, top_k=top_k)
-        scores = self._get_scores(query_text, retrieved_files)
-        
-        return prompt, retrieved_files, scores
-    
-    def _get_scores(self, query_text, retrieved_files):
-        """Get similarity scores for retrieved files."""
-        results = self.faiss_index.retrieve(
-            self.vectorizer.model.encode([query_text], convert_to_numpy=True),
-            top_k=len(retrieved_files)
+        self.faiss_index = FAISSIndex(
+            self.vectors, self.docs,
+            index_spec=index_spec, nprobe=nprobe, ef_search=ef_search, storage=storage
         )
-        return [result["score"] for result in results]
-    
-    def generate_answer(self, query_text, top_k = 3, llm_model = "gemini-2.5-flash"):
-        prompt, retrieved_files, scores = self.query(query_text, top_k=top_k)
+        # Near-duplicate patents collapse to their best hit when dedup_threshold (cosine) is set
+        self.duplicates = None
+        if dedup_threshold is not None:
+            self.set_dedup_threshold(dedup_threshold)
+        self.sparse_index = None
+        self.chunk_index = None
+        self.sentence_vectors = None
+        if context_scoring == "dense":
+            self.sentence_vectors = self.data_handler.load_sentence_vectors(self.docs, dataset_tag, self.vectorizer)
+        self.reranker = reranker
+        self.set_retrieval_mode(retrieval_mode)
+
+    def set_retrieval_mode(self, retrieval_mode):
+        """Switches between dense, sparse, hybrid and chunks retrieval, building the BM25 or chunk index on first use."""
+        if retrieval_mode in ("sparse", "hybrid") and self.sparse_index is None:
+            self.sparse_index = self.data_handler.load_sparse_index(self.docs, self.dataset_tag, self.ner_model_name)
+        if retrieval_mode == "chunks" and self.chunk_index is None:
+            self.chunk_index = self.data_handler.load_chunk_index(
+                self.docs, self.dataset_tag, self.vectorizer,
+                index_spec=self.chunk_index_spec, nprobe=self.nprobe, ef_search=self.ef_search
+            )
+        self.rag = PatentsRAG(
+            self.faiss_index, self.vectorizer, score_threshold=self.score_threshold,
+            sparse_index=self.sparse_index, retrieval_mode=retrieval_mode, reranker=self.reranker,
+            chunk_index=self.chunk_index, chunk_aggregation=self.chunk_aggregation,
+            sentence_vectors=self.sentence_vectors, context_scoring=self.context_scoring
+        )
+
+    def set_dedup_threshold(self, dedup_threshold):
+        """Builds (or loads) near-duplicate clusters at dedup_threshold and collapses them in retrieval; None turns it off."""
+        if dedup_threshold is None:
+            self.duplicates = None
+        else:
+            BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+            folder = os.path.join(BASE_DIR, "cache", f"duplicates_{self.dataset_tag}_{self.vectorizer.get_model_tag()}")
+            self.duplicates = DuplicateClusters.load_or_build(folder, self.docs, self.vectors, threshold=dedup_threshold)
+        self.faiss_index.set_duplicates(self.duplicates)
+
+    def set_reranker(self, reranker):
+        """Turns the cross-encoder stage on (a reranker.Reranker) or off (None)."""
+        self.reranker = reranker
+        self.rag.reranker = reranker
+
+    def refresh(self):
+        """Picks up added, changed or deleted patents without rebuilding the index (HNSW indexes are rebuilt
+        when patents changed or were deleted, they cannot remove vectors)."""
+        texts, docs = self.data_handler.load_texts(
+            dataset_tag=self.dataset_tag,
+            ner_model_name=self.ner_model_name
+        )
+        self.vectors, added_ids, removed_ids = self.vectorizer.sync_vectors(
+            texts, docs, self.dataset_tag,
+            batch_size=self.batch_size, mmap=self.storage != "float32", processes=self.encode_processes
+        )
+        self.docs = docs
+
+        changed = [doc_id for doc_id in added_ids if doc_id in self.faiss_index.id_of]
+        if (removed_ids or changed) and not self.faiss_index.supports_removal:
+            # HNSW graphs cannot drop nodes: rebuild from the synced vectors instead
+            print(f"{self.index_spec} cannot update docs in place, rebuilding the index...")
+            self.faiss_index = FAISSIndex(
+                self.vectors, self.docs,
+                index_spec=self.index_spec, nprobe=self.nprobe, ef_search=self.ef_search, storage=self.storage
+            )
+            self.rag.index = self.faiss_index
+        else:
+            self.faiss_index.remove_ids(removed_ids)
+            added = set(added_ids)
+            rows = [i for i, doc in enumerate(docs) if doc["id"] in added]
+            self.faiss_index.add_with_ids(self.vectors[rows], [docs[i] for i in rows])
+        if self.duplicates is not None:
+            # Clusters come from the old vectors: changed patents leave their cluster, and like new ones stay
+            # uncollapsed until the clusters are rebuilt
+            self.duplicates.detach(added_ids)
+            self.faiss_index.set_duplicates(self.duplicates)
+        if self.sparse_index is not None and (added_ids or removed_ids):
+            self.sparse_index = self.data_handler.load_sparse_index(docs, self.dataset_tag, self.ner_model_name)
+            self.rag.sparse_index = self.sparse_index
+        if self.chunk_index is not None and (added_ids or removed_ids):
+            self.chunk_index = self.data_handler.load_chunk_index(
+                docs, self.dataset_tag, self.vectorizer,
+                index_spec=self.chunk_index_spec, nprobe=self.nprobe, ef_search=self.ef_search
+            )
+            self.rag.chunk_index = self.chunk_index
+        if self.sentence_vectors is not None and (added_ids or removed_ids):
+            self.sentence_vectors = self.data_handler.load_sentence_vectors(docs, self.dataset_tag, self.vectorizer)
+            self.rag.packer.sentence_vectors = self.sentence_vectors
+
+        return added_ids, removed_ids
+
+    def retrieve(self, query_text, top_k = 3, filters = None):
+        return self.rag.retrieve(query_text, top_k=top_k, model_name=self.model_name, filters=filters)
+
+    def retrieve_batch(self, query_texts, top_k = 3, filters = None):
+        """Batched retrieve: encodes all queries in one pass and runs a single index search."""
+        return self.rag.retrieve_batch(query_texts, top_k=top_k, model_name=self.model_name, filters=filters)
+
+    def query(self, query_text, top_k = 3, filters = None):
+        """filters narrows the search, e.g. {"cpc": ["H01M"], "date_from": "2016-01-01", "date_to": "2016-12-31"}."""
+        result = self.retrieve(query_text, top_k=top_k, filters=filters)
+        return result.prompt, result.files, result.scores
+
+    def retrieve_range(self, query_text, min_score = None, max_results = 20, offset = 0, filters = None):
+        return self.rag.retrieve_range(
+            query_text, model_name=self.model_name, min_score=min_score,
+            max_results=max_results, offset=offset, filters=filters
+        )
+
+    def query_range(self, query_text, min_score = None, max_results = 20, offset = 0, filters = None):
+        """All patents scoring at least min_score, paginated by offset/max_results; also returns the total."""
+        result = self.retrieve_range(query_text, min_score, max_results, offset, filters)
+        return result.prompt, result.files, result.scores, result.total
+
+    def query_batch(self, query_texts, top_k = 3, filters = None):
+        return [
+            (result.prompt, result.files, result.scores)
+            for result in self.retrieve_batch(query_texts, top_k=top_k, filters=filters)
+        ]
+
+    def generate_answer(self, query_text, top_k = 3, llm_model = "gemini-2.5-flash", result = None, filters = None):
+        if result is None:
+            result = self.retrieve(query_text, top_k=top_k, filters=filters)
+        if not result.has_evidence:
+            return result.prompt, result.files, result.scores
         
+        from google import genai
         llm = LLM(
             client=genai.Client(api_key=os.getenv("API_KEY")),
             model=llm_model
         )
-        answer = llm.generate_text(prompt)
+        answer = llm.generate_text(result.prompt)
         
-        return answer, retrieved_files, scores
+        return answer, result.files, result.scores
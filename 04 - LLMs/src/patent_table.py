@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from metadata_index import parse_day
+
+# Columnar table of the patent metadata used for trend analytics, one row per patent file:
+#   ids.npy                                    patent id (file stem)
+#   filing_day / issue_day / published_day     int32 YYYYMMDD, 0 when missing
+#   decision                                   int8 position in decision_labels
+#   main_cpc / main_ipc                        int32 position in cpc_vocab / ipc_vocab, -1 when missing
+#   cpc_offsets, cpc_codes / ipc_offsets, ipc_codes
+#                                              every label of row i: codes[offsets[i]:offsets[i + 1]]
+# plus table.json (vocabularies and the signature of the files it was built from). Group-bys are bincounts
+# over these columns, the raw JSON is only read by build().
+
+DATE_COLUMNS = {"filing_date": "filing_day", "patent_issue_date": "issue_day", "date_published": "published_day"}
+PERIODS = {"year": 10000, "month": 100}
+COLUMNS = ("filing_day", "issue_day", "published_day", "decision", "main_cpc", "main_ipc",
+           "cpc_offsets", "cpc_codes", "ipc_offsets", "ipc_codes")
+
+
+def _extract(file):
+    """The table fields of one patent file, or None when it cannot be parsed."""
+    try:
+        with open(file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        print(f"Error processing {Path(file).name}: {e}")
+        return None
+    return {
+        "id": Path(file).stem,
+        "filing_date": data.get("filing_date"),
+        "patent_issue_date": data.get("patent_issue_date"),
+        "date_published": data.get("date_published"),
+        "decision": data.get("decision") or "",
+        "main_cpc_label": data.get("main_cpc_label") or "",
+        "cpc_labels": data.get("cpc_labels") or [],
+        "main_ipcr_label": data.get("main_ipcr_label") or "",
+        "ipcr_labels": data.get("ipcr_labels") or [],
+    }
+
+
+def _period_range(periods, by):
+    """Every period from the first to the last of periods, so adjacent columns are adjacent periods."""
+    if len(periods) == 0:
+        return np.asarray(periods, dtype=np.int64)
+    first, last = int(periods.min()), int(periods.max())
+    if by == "year":
+        return np.arange(first, last + 1, dtype=np.int64)
+    # YYYYMM: step through month numbers so December is followed by January of the next year
+    months = np.arange(first // 100 * 12 + first % 100 - 1, last // 100 * 12 + last % 100, dtype=np.int64)
+    return months // 12 * 100 + months % 12 + 1
+
+
+class _Vocab:
+    def __init__(self):
+        self.labels = []
+        self.codes = {}
+
+    def code(self, label):
+        if not label:
+            return -1
+        code = self.codes.get(label)
+        if code is None:
+            code = self.codes[label] = len(self.labels)
+            self.labels.append(label)
+        return code
+
+
+class PatentTable:
+    TABLE_FILE = "table.json"
+    IDS_FILE = "ids.npy"
+
+    def __init__(self, ids, columns, cpc_vocab, ipc_vocab, decision_labels, signature=None):
+        self.ids = ids
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+        self.cpc_vocab = cpc_vocab
+        self.ipc_vocab = ipc_vocab
+        self.decision_labels = decision_labels
+        self.signature = signature
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def files_signature(files):
+        """sha1 of file names, sizes and modification times: a stat per file, no reads."""
+        digest = hashlib.sha1()
+        for file in files:
+            stat = os.stat(file)
+            digest.update(f"{Path(file).name}\x1f{stat.st_size}\x1f{stat.st_mtime_ns}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, dataset_path, n_workers=None, chunk_size=256):
+        """Reads every patent JSON of dataset_path once, in parallel, and keeps only the table fields."""
+        files = sorted(Path(dataset_path).glob("*.json"))
+        ids = []
+        days = {column: [] for column in DATE_COLUMNS.values()}
+        decisions, main_cpc, main_ipc = [], [], []
+        cpc_codes, cpc_counts, ipc_codes, ipc_counts = [], [], [], []
+        cpc_vocab, ipc_vocab, decision_vocab = _Vocab(), _Vocab(), _Vocab()
+
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for i, record in enumerate(pool.map(_extract, files, chunksize=chunk_size)):
+                if record is None:
+                    continue
+                ids.append(record["id"])
+                for field, column in DATE_COLUMNS.items():
+                    days[column].append(parse_day(record[field]))
+                decisions.append(decision_vocab.code(record["decision"]))
+                main_cpc.append(cpc_vocab.code(record["main_cpc_label"]))
+                main_ipc.append(ipc_vocab.code(record["main_ipcr_label"]))
+                labels = [cpc_vocab.code(label) for label in record["cpc_labels"] if label]
+                cpc_codes.extend(labels)
+                cpc_counts.append(len(labels))
+                labels = [ipc_vocab.code(label) for label in record["ipcr_labels"] if label]
+                ipc_codes.extend(labels)
+                ipc_counts.append(len(labels))
+                if (i + 1) % 50_000 == 0:
+                    print(f"Extracted {i + 1}/{len(files)} patent files")
+
+        columns = {column: np.asarray(values, dtype=np.int32) for column, values in days.items()}
+        columns["decision"] = np.asarray(decisions, dtype=np.int8)
+        columns["main_cpc"] = np.asarray(main_cpc, dtype=np.int32)
+        columns["main_ipc"] = np.asarray(main_ipc, dtype=np.int32)
+        columns["cpc_offsets"] = np.concatenate([[0], np.cumsum(cpc_counts, dtype=np.int64)])
+        columns["cpc_codes"] = np.asarray(cpc_codes, dtype=np.int32)
+        columns["ipc_offsets"] = np.concatenate([[0], np.cumsum(ipc_counts, dtype=np.int64)])
+        columns["ipc_codes"] = np.asarray(ipc_codes, dtype=np.int32)
+        print(f"Patent table built from {len(ids)} files")
+        return cls(np.asarray(ids), columns, cpc_vocab.labels, ipc_vocab.labels, decision_vocab.labels,
+                   cls.files_signature(files))
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, self.IDS_FILE), self.ids)
+        for name in COLUMNS:
+            np.save(os.path.join(folder, f"{name}.npy"), getattr(self, name))
+        # The table file is written last, its presence marks a complete table
+        with open(os.path.join(folder, self.TABLE_FILE), "w") as f:
+            json.dump({
+                "cpc_vocab": self.cpc_vocab,
+                "ipc_vocab": self.ipc_vocab,
+                "decision_labels": self.decision_labels,
+                "signature": self.signature,
+            }, f)
+
+    @classmethod
+    def load(cls, folder):
+        with open(os.path.join(folder, cls.TABLE_FILE), "r") as f:
+            meta = json.load(f)
+        ids = np.load(os.path.join(folder, cls.IDS_FILE))
+        columns = {name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r") for name in COLUMNS}
+        return cls(ids, columns, meta["cpc_vocab"], meta["ipc_vocab"], meta["decision_labels"], meta.get("signature"))
+
+    @classmethod
+    def load_or_build(cls, folder, dataset_path, n_workers=None):
+        """Reuses the table saved in folder while the dataset files are unchanged, otherwise rebuilds it."""
+        signature = cls.files_signature(sorted(Path(dataset_path).glob("*.json")))
+        try:
+            table = cls.load(folder)
+            if table.signature == signature:
+                return table
+        except FileNotFoundError:
+            pass
+        print(f"Extracting patent table from {dataset_path}...")
+        table = cls.build(dataset_path, n_workers=n_workers)
+        table.save(folder)
+        return table
+
+    def _rows(self, decision=None, date_from=None, date_to=None, date_field="filing_date"):
+        """Bool mask of the rows passing the filters; decision is a label or a list of labels."""
+        mask = np.ones(len(self), dtype=bool)
+        if decision is not None:
+            wanted = [decision] if isinstance(decision, str) else decision
+            codes = [code for code, label in enumerate(self.decision_labels) if label in wanted]
+            mask &= np.isin(self.decision, codes)
+        if date_from or date_to:
+            days = getattr(self, DATE_COLUMNS[date_field])
+            mask &= (days >= parse_day(date_from)) & (days <= (parse_day(date_to, upper=True) or 99991231))
+        return mask
+
+    def _labels(self, scheme, level, rows, all_labels):
+        """(row of each label, group code of each label, group names) for the rows in mask rows.
+
+        level truncates labels, e.g. 4 for subclasses ("H01M"); None keeps the full label."""
+        vocab = self.cpc_vocab if scheme == "cpc" else self.ipc_vocab
+        names, group = np.unique(np.array([label[:level] if level else label for label in vocab] or [""]),
+                                 return_inverse=True)
+        group = np.append(group.astype(np.int32), -1)  # code -1 (no label) maps to group -1
+        if all_labels:
+            offsets = getattr(self, f"{scheme}_offsets")
+            counts = np.diff(offsets)
+            label_rows = np.repeat(np.arange(len(self)), counts)
+            codes = np.asarray(getattr(self, f"{scheme}_codes"))
+            keep = rows[label_rows]
+            label_rows, codes = label_rows[keep], codes[keep]
+        else:
+            label_rows = np.flatnonzero(rows)
+            codes = np.asarray(getattr(self, f"main_{scheme}"))[label_rows]
+        groups = group[codes]
+        known = groups >= 0
+        return label_rows[known], groups[known], names.tolist()
+
+    def counts(self, by="year", scheme="cpc", level=4, decision=None, date_from=None, date_to=None,
+               date_field="filing_date", all_labels=False):
+        """Patents per label group per period. Returns (codes, periods, counts) with counts[code, period].
+
+        by is "year" (periods like 2016) or "month" (201603); periods run contiguously from the first to the
+        last one in the selection, with zero counts for empty ones. scheme is "cpc" or "ipc" (IPC also covers
+        filings from before CPC existed); all_labels counts every label of a patent instead of only its main one."""
+        rows = self._rows(decision, date_from, date_to, date_field)
+        days = np.asarray(getattr(self, DATE_COLUMNS[date_field]))
+        rows &= days > 0
+        label_rows, groups, names = self._labels(scheme, level, rows, all_labels)
+        period_of_row = days // PERIODS[by]
+        periods = _period_range(period_of_row[rows], by)
+        period_index = np.searchsorted(periods, period_of_row[label_rows])
+        counts = np.bincount(groups * len(periods) + period_index, minlength=len(names) * len(periods))
+        counts = counts.reshape(len(names), len(periods))
+        # Only groups that occur in the selection
+        present = counts.sum(axis=1) > 0
+        return [name for name, keep in zip(names, present) if keep], periods, counts[present]
+
+    def top_n(self, n=10, scheme="cpc", level=4, all_labels=False, **filters):
+        """The n most frequent label groups, as [(code, count)] best first, like CPCAnalyzer.get_top_n."""
+        _, groups, names = self._labels(scheme, level, self._rows(**filters), all_labels)
+        totals = np.bincount(groups, minlength=len(names))
+        order = np.argsort(-totals, kind="stable")[:n]
+        return [(names[i], int(totals[i])) for i in order if totals[i] > 0]
+
+    def shares(self, by="year", **options):
+        """Like counts(), with each period's counts divided by the patents filed in that period."""
+        codes, periods, counts = self.counts(by=by, **options)
+        date_field = options.get("date_field", "filing_date")
+        rows = self._rows(options.get("decision"), options.get("date_from"), options.get("date_to"), date_field)
+        days = np.asarray(getattr(self, DATE_COLUMNS[date_field]))[rows]
+        totals = np.bincount(np.searchsorted(periods, days[days > 0] // PERIODS[by]), minlength=len(periods))
+        return codes, periods, counts / np.maximum(totals, 1)
+
+    def growth(self, by="year", **options):
+        """Period-over-period growth rates, (codes, periods[1:], rates); nan where the previous count is 0."""
+        codes, periods, counts = self.counts(by=by, **options)
+        previous = counts[:, :-1].astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates = np.where(previous > 0, (counts[:, 1:] - previous) / previous, np.nan)
+        return codes, periods[1:], rates
+
+    def rows_for(self, code, scheme="cpc", **filters):
+        """Ids of the patents whose main label starts with code (e.g. "H01M"), for sampling or drill-down."""
+        vocab = self.cpc_vocab if scheme == "cpc" else self.ipc_vocab
+        codes = [i for i, label in enumerate(vocab) if label.startswith(code)]
+        mask = self._rows(**filters) & np.isin(getattr(self, f"main_{scheme}"), codes)
+        return self.ids[mask]
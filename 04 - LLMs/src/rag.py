@@ -1,74 +1,224 @@
+from dataclasses import dataclass, field
+import numpy as np
+from context_packer import ContextPacker
+
+BGE_MODEL_NAME = "BAAI/bge-large-en-v1.5"
+BGE_QUERY_INSTRUCTION = "Represent this sentence for searching relevant passages: "
+# dense: FAISS only. sparse: BM25 candidates rescored by cosine, no dense scan.
+# hybrid: FAISS and BM25 candidate lists fused with reciprocal rank fusion.
+# chunks: full_description windows (chunk_index.ChunkIndex), chunk hits aggregated per patent.
+RETRIEVAL_MODES = ("dense", "sparse", "hybrid", "chunks")
+
+@dataclass
+class RetrievalResult:
+    """Everything one retrieval produced, so callers never encode or search the same query twice."""
+    query: str
+    # Every doc retrieval returned (above the threshold, after reranking), best first
+    docs: list = field(default_factory=list)
+    prompt: str = "insufficient evidence"
+    # The docs the prompt cites: those of docs that got context into the token budget
+    cited: list = field(default_factory=list)
+    query_vec: object = None
+    # For threshold retrieval: how many docs passed the threshold, of which docs is one page
+    total: int = None
+
+    @property
+    def ids(self):
+        return [doc["id"] for doc in self.docs]
+
+    @property
+    def scores(self):
+        return [doc["score"] for doc in self.docs]
+
+    @property
+    def files(self):
+        return [f"{doc['id']}.json" for doc in self.docs]
+
+    @property
+    def has_evidence(self):
+        return bool(self.cited)
+
+
 class PatentsRAG:
-    def __init__(self, faiss_index, vectorizer, score_threshold=0.7):
+    def __init__(self, faiss_index, vectorizer, score_threshold=0.7, sparse_index=None, retrieval_mode="dense",
+                 candidates=50, rrf_k=60, reranker=None, context_tokens=1500, chunk_index=None,
+                 chunk_aggregation="max", passages_per_doc=2, sentence_vectors=None, context_scoring="dense"):
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {retrieval_mode}, expected one of {RETRIEVAL_MODES}")
+        if retrieval_mode in ("sparse", "hybrid") and sparse_index is None:
+            raise ValueError(f"Retrieval mode {retrieval_mode} needs a sparse index")
+        if retrieval_mode == "chunks" and chunk_index is None:
+            raise ValueError("Retrieval mode chunks needs a chunk index")
         self.index = faiss_index
         self.vectorizer = vectorizer
         self.score_threshold = score_threshold
+        self.sparse_index = sparse_index
+        self.retrieval_mode = retrieval_mode
+        # Candidates taken from each retriever before fusion, and the RRF rank constant
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        # Optional cross-encoder stage (reranker.Reranker) between retrieval and prompt construction
+        self.reranker = reranker
+        # Chunk retrieval: "max" or "sum" of chunk scores per patent, and how many best chunks go to the prompt
+        self.chunk_index = chunk_index
+        self.chunk_aggregation = chunk_aggregation
+        self.passages_per_doc = passages_per_doc
+        # Prompt context is packed into this many tokens, whatever top_k is; "dense" scoring reads the
+        # precomputed sentence vectors (sentence_vectors.SentenceVectors), "lexical" needs none
+        self.packer = ContextPacker(
+            vectorizer, max_tokens=context_tokens, scoring=context_scoring, sentence_vectors=sentence_vectors
+        )
+
+    def encode_queries(self, query_texts, model_name="all-MiniLM-L6-v2"):
+        """Encodes all queries in one forward pass, adding the bge query instruction when needed."""
+        instruction = BGE_QUERY_INSTRUCTION if model_name == BGE_MODEL_NAME else ""
+        return self.vectorizer.encode_queries(query_texts, instruction=instruction)
 
-    def truncate_context(self, results, chars_per_result):
-        truncated = [text[:chars_per_result] for text in results]
-        return "\n".join(truncated)
+    def retrieve_batch(self, query_texts, top_k, model_name="all-MiniLM-L6-v2", filters=None):
+        """One encode and one index search for all queries; returns a RetrievalResult per query.
 
-    def generate_prompt(self, query_text, top_k, model_name="all-MiniLM-L6-v2"):
-        if model_name == "BAAI/bge-large-en-v1.5":
-            query_search = "Represent this sentence for searching relevant passages: " + query_text
-            query_vec = self.vectorizer.encode_texts([query_search])[0]
+        filters (e.g. {"cpc": ["H01M"], "date_from": "2016"}) restrict the search to matching patents."""
+        query_vecs = self.encode_queries(query_texts, model_name)
+        # With a reranker, retrieve its candidate budget and let it pick the top_k
+        fetch_k = max(self.reranker.candidates, top_k) if self.reranker is not None else top_k
+        if self.retrieval_mode == "dense":
+            batch_docs = self.index.retrieve_batch(
+                query_vecs, top_k=fetch_k, filters=filters, min_score=self.score_threshold
+            )
+        elif self.retrieval_mode == "chunks":
+            hits = self.chunk_index.search(
+                query_vecs, top_k=fetch_k, aggregation=self.chunk_aggregation,
+                parent_mask=self._filter_mask(self.chunk_index.patent_ids, filters)
+            )
+            batch_docs = [self._chunk_docs(patent_hits) for patent_hits in hits]
+        elif self.retrieval_mode == "sparse":
+            sparse_mask = self._sparse_mask(filters)
+            batch_docs = [
+                self._sparse_retrieve(query_text, query_vec, fetch_k, sparse_mask)
+                for query_text, query_vec in zip(query_texts, query_vecs)
+            ]
         else:
-            query_vec = self.vectorizer.encode_texts([query_text])[0]
-        filtered_docs = self.index.retrieve(query_vec, top_k=top_k)
-        
-        filtered_docs = [doc for doc in filtered_docs if doc["score"] >= self.score_threshold]
+            sparse_mask = self._sparse_mask(filters)
+            dense_docs = self.index.retrieve_batch(
+                query_vecs, top_k=max(self.candidates, fetch_k), filters=filters, min_score=self.score_threshold
+            )
+            batch_docs = [
+                self._fuse(query_text, query_vec, docs, fetch_k, sparse_mask)
+                for query_text, query_vec, docs in zip(query_texts, query_vecs, dense_docs)
+            ]
+        if self.reranker is not None:
+            batch_docs = [
+                self.reranker.rerank(query_text, docs, top_k)
+                for query_text, docs in zip(query_texts, batch_docs)
+            ]
+        results = []
+        for query_text, query_vec, docs in zip(query_texts, query_vecs, batch_docs):
+            filtered_docs = [doc for doc in docs if doc["score"] >= self.score_threshold]
+            prompt, cited = self.build_prompt(query_text, filtered_docs, query_vec)
+            results.append(RetrievalResult(
+                query=query_text, docs=filtered_docs, prompt=prompt, cited=cited, query_vec=query_vec
+            ))
+        return results
 
-        print(filtered_docs)
+    def retrieve_range(self, query_text, model_name="all-MiniLM-L6-v2", min_score=None, max_results=20, offset=0,
+                       filters=None):
+        """Every patent with cosine score >= min_score (score_threshold by default), one page at a time.
 
-        if not filtered_docs:
-            return "insufficient evidence"
-        
-        context_blocks = []
-        
-        for doc in filtered_docs:
-            score_pct = f"{doc['score'] * 100:.2f}%"
-            entities = ", ".join(doc["entities"])
-            excerpt = doc.get("text")
-
-            if len(excerpt) > 1500:
-                excerpt = excerpt[:1500] + " ...[truncated]"
-            block = (
-                f"PATENT {doc['id']} (score: {score_pct})\n"
-                f"Excerpt:\n{excerpt}\n"
-                f"Entities:\n{entities}\n"
-            )
-            context_blocks.append(block)
+        Dense only: the threshold is a cosine similarity. result.total tells how many passed it."""
+        min_score = self.score_threshold if min_score is None else min_score
+        query_vec = self.encode_queries([query_text], model_name)[0]
+        docs, total = self.index.range_retrieve_batch(
+            query_vec, min_score, max_results=max_results, offset=offset, filters=filters
+        )[0]
+        prompt, cited = self.build_prompt(query_text, docs, query_vec)
+        return RetrievalResult(
+            query=query_text, docs=docs, prompt=prompt, cited=cited, query_vec=query_vec, total=total
+        )
 
-        context_text = "\n\n".join(context_blocks)
-        patent_ids = ", ".join([doc["id"] for doc in filtered_docs])
-        patent_scores = ", ".join(
-            [f"{doc['score'] * 100:.2f}% precision" for doc in filtered_docs]
+    def _filter_mask(self, doc_ids, filters):
+        """Boolean mask over doc_ids of the docs that pass filters, None when nothing is filtered."""
+        allowed = self.index.metadata.select(filters) if filters else None
+        if allowed is None:
+            return None
+        internal_ids = np.fromiter(
+            (self.index.id_of.get(doc_id, -1) for doc_id in doc_ids), dtype=np.int64, count=len(doc_ids)
         )
+        return np.isin(internal_ids, allowed)
+
+    def _sparse_mask(self, filters):
+        return self._filter_mask(self.sparse_index.ids, filters)
 
-        for doc in filtered_docs: 
-            print(doc["score"])
-        
-        prompt = f"""
-        You are an expert patent analyst. Follow these strict rules:
+    def _chunk_docs(self, patent_hits):
+        docs = []
+        for patent_id, score, chunk_rows in patent_hits:
+            if patent_id not in self.index.id_of:
+                continue
+            doc = self.index.get_doc(patent_id).copy()
+            doc["score"] = score
+            # The description windows that matched, best first, for the context packer
+            rows = chunk_rows[:self.passages_per_doc]
+            doc["passages"] = [self.chunk_index.chunk_text(row) for row in rows]
+            doc["passage_vectors"] = [np.asarray(self.chunk_index.vectors[row]) for row in rows]
+            docs.append(doc)
+        return docs
 
-        1) Use ONLY the information explicitly present in the CONTEXT.  
-        Do NOT add external knowledge, interpretations, generalizations, or assumptions.
+    def _sparse_candidates(self, query_text, n, mask=None):
+        """BM25 top-n as (doc_id, bm25_score), skipping docs no longer in the dense index."""
+        rows, scores = self.sparse_index.search(query_text, top_k=n, mask=mask)
+        ids = self.sparse_index.ids
+        return [(ids[row], float(score)) for row, score in zip(rows, scores) if ids[row] in self.index.id_of]
 
-        2) If the answer cannot be fully supported by the CONTEXT, respond exactly:
-        "insufficient evidence"
+    def _sparse_doc(self, doc_id, score, bm25_score):
+        doc = self.index.get_doc(doc_id).copy()
+        doc["score"] = float(score)
+        doc["bm25_score"] = bm25_score
+        return doc
 
-        3) Every factual statement must cite the supporting patent ID(s) in parentheses.
+    def _sparse_retrieve(self, query_text, query_vec, top_k, mask=None):
+        candidates = self._sparse_candidates(query_text, max(self.candidates, top_k), mask)
+        scores = self.index.score_ids(query_vec, [doc_id for doc_id, _ in candidates])
+        ranked = sorted(zip(candidates, scores), key=lambda item: -item[1])[:top_k]
+        return [
+            self._sparse_doc(doc_id, score, bm25_score)
+            for (doc_id, bm25_score), score in ranked if score >= self.score_threshold
+        ]
 
-        4) At the end of the output, append exactly:
-        Referenced patent(s): {patent_ids}
-        Patent Score(s): {patent_scores}
+    def _fuse(self, query_text, query_vec, dense_docs, top_k, mask=None):
+        sparse = self._sparse_candidates(query_text, max(self.candidates, top_k), mask)
+        fused = {}
+        for rank, doc in enumerate(dense_docs):
+            fused[doc["id"]] = fused.get(doc["id"], 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        for rank, (doc_id, _) in enumerate(sparse):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        top_ids = sorted(fused, key=lambda doc_id: -fused[doc_id])[:top_k]
 
-        QUESTION:
-        {query_text}
+        # "score" stays a cosine similarity so score_threshold means the same in every mode
+        dense_by_id = {doc["id"]: doc for doc in dense_docs}
+        bm25_by_id = dict(sparse)
+        missing = [doc_id for doc_id in top_ids if doc_id not in dense_by_id]
+        missing_scores = dict(zip(missing, self.index.score_ids(query_vec, missing)))
+        docs = []
+        for doc_id in top_ids:
+            if doc_id in dense_by_id:
+                doc = dense_by_id[doc_id]
+                doc["bm25_score"] = bm25_by_id.get(doc_id)
+            else:
+                doc = self._sparse_doc(doc_id, missing_scores[doc_id], bm25_by_id[doc_id])
+            doc["rrf_score"] = fused[doc_id]
+            docs.append(doc)
+        return docs
 
-        CONTEXT:
-        {context_text}
+    def retrieve(self, query_text, top_k, model_name="all-MiniLM-L6-v2", filters=None):
+        return self.retrieve_batch([query_text], top_k, model_name, filters)[0]
 
-        """
+    def generate_prompts(self, query_texts, top_k, model_name="all-MiniLM-L6-v2", filters=None):
+        return [(result.prompt, result.files) for result in self.retrieve_batch(query_texts, top_k, model_name, filters)]
 
-        return prompt, [f"{doc['id']}.json" for doc in filtered_docs]
\ No newline at end of file
+    def generate_prompt(self, query_text, top_k, model_name="all-MiniLM-L6-v2", filters=None):
+        return self.generate_prompts([query_text], top_k, model_name, filters)[0]
+
+    def build_prompt(self, query_text, filtered_docs, query_vec=None):
+        """Prompt packed into the token budget. Returns (prompt, docs it cites)."""
+        if not filtered_docs:
+            return "insufficient evidence", []
+        return self.packer.build_prompt(query_text, filtered_docs, query_vec)
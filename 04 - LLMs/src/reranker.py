@@ -0,0 +1,114 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import model_registry
+
+DEFAULT_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class Reranker:
+    """Cross-encoder second stage: rescores the bi-encoder's top candidates as (query, passage) pairs.
+
+    Pairs are scored in batches on CPU and cached by (query, passage). With time_budget_ms set, scoring stops
+    at the first batch boundary past the budget and the request keeps the bi-encoder order.
+    """
+
+    def __init__(self, model_name=DEFAULT_RERANK_MODEL, candidates=20, batch_size=16, time_budget_ms=None,
+                 cache_size=4096, device="cpu"):
+        self.model_name = model_name
+        # How many bi-encoder hits are fetched and rescored per query
+        self.candidates = candidates
+        self.batch_size = batch_size
+        self.time_budget = time_budget_ms / 1000 if time_budget_ms else None
+        self.cache_size = cache_size
+        self.device = device
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.fallbacks = 0
+        self.pairs_scored = 0
+        self.cache_hits = 0
+        self.total_time = 0.0
+
+    @property
+    def model(self):
+        return model_registry.get_cross_encoder(self.model_name, self.device)
+
+    def warm_up(self):
+        self.model.predict([("warm up", "warm up")])
+
+    @staticmethod
+    def passage(doc):
+        return doc.get("text", "")
+
+    def _key(self, query_text, passage):
+        return hashlib.sha1(f"{query_text}\x1f{passage}".encode("utf-8")).hexdigest()
+
+    def _cached(self, key):
+        with self._lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _store(self, keys, scores):
+        with self._lock:
+            for key, score in zip(keys, scores):
+                self._cache[key] = score
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def rerank(self, query_text, docs, top_k):
+        """Returns the top_k of docs by cross-encoder score (doc["rerank_score"]), or docs[:top_k] if over budget."""
+        if not docs:
+            return docs
+        start = time.perf_counter()
+        keys = [self._key(query_text, self.passage(doc)) for doc in docs]
+        scores = [self._cached(key) for key in keys]
+        todo = [i for i, score in enumerate(scores) if score is None]
+        cache_hits = len(docs) - len(todo)
+
+        over_budget = False
+        for batch_start in range(0, len(todo), self.batch_size):
+            if self.time_budget is not None and time.perf_counter() - start > self.time_budget:
+                over_budget = True
+                break
+            batch = todo[batch_start:batch_start + self.batch_size]
+            pairs = [(query_text, self.passage(docs[i])) for i in batch]
+            batch_scores = [float(score) for score in self.model.predict(pairs, batch_size=self.batch_size)]
+            # Finished batches are cached even if the request falls back later
+            self._store([keys[i] for i in batch], batch_scores)
+            for i, score in zip(batch, batch_scores):
+                scores[i] = score
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.requests += 1
+            self.cache_hits += cache_hits
+            self.pairs_scored += sum(1 for i in todo if scores[i] is not None)
+            self.total_time += elapsed
+            if over_budget:
+                self.fallbacks += 1
+
+        if over_budget:
+            return docs[:top_k]
+        order = sorted(range(len(docs)), key=lambda i: -scores[i])[:top_k]
+        reranked = []
+        for i in order:
+            docs[i]["rerank_score"] = scores[i]
+            reranked.append(docs[i])
+        return reranked
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "candidates": self.candidates,
+            "time_budget_ms": self.time_budget * 1000 if self.time_budget is not None else None,
+            "requests": self.requests,
+            "fallbacks": self.fallbacks,
+            "pairs_scored": self.pairs_scored,
+            "cache_hits": self.cache_hits,
+            "mean_ms": self.total_time / self.requests * 1000 if self.requests else 0.0,
+        }
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import faiss
+import numpy as np
+from context_packer import doc_sentences
+
+
+class SentenceVectors:
+    """Unit vectors of the sentences of every doc's excerpt (title and abstract), encoded offline.
+
+    The context packer scores sentences by cosine with the query vector retrieval already computed, so it
+    reads these instead of running the encoder per query. Built in one streaming pass like ChunkIndex:
+    sentences are encoded block by block into a raw float16 file that is memory-mapped when serving.
+    The sentences of the doc at row i of ids are vectors[offsets[i]:offsets[i + 1]].
+    """
+
+    VECTORS_FILE = "sentence_vectors.f16"
+    OFFSETS_FILE = "sentence_offsets.npy"
+    META_FILE = "sentences.json"
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, self.META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.row_of = {doc_id: row for row, doc_id in enumerate(self.meta["ids"])}
+        self.offsets = np.load(os.path.join(folder, self.OFFSETS_FILE), mmap_mode="r")
+        count = int(self.offsets[-1]) if len(self.offsets) else 0
+        self.vectors = np.memmap(os.path.join(folder, self.VECTORS_FILE), dtype=np.float16, mode="r",
+                                 shape=(count, self.meta["dim"])) if count else np.empty((0, self.meta["dim"]))
+
+    @staticmethod
+    def signature(docs):
+        digest = hashlib.sha1()
+        for doc in docs:
+            digest.update(doc["id"].encode("utf-8"))
+            digest.update(doc.get("text", "").encode("utf-8"))
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, folder, docs, encode, block_size=4096, signature=None):
+        """encode maps a list of texts to an (n, d) array, e.g. Vectorizer.encode_texts."""
+        os.makedirs(folder, exist_ok=True)
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        dim = None
+        block = []
+
+        with open(os.path.join(folder, cls.VECTORS_FILE), "wb") as vectors_file:
+            def flush():
+                nonlocal dim
+                vectors = np.asarray(encode(block), dtype=np.float32)
+                faiss.normalize_L2(vectors)
+                dim = vectors.shape[1]
+                vectors_file.write(vectors.astype(np.float16).tobytes())
+                block.clear()
+
+            for row, doc in enumerate(docs):
+                sentences = doc_sentences(doc)
+                offsets[row + 1] = offsets[row] + len(sentences)
+                block.extend(sentences)
+                if len(block) >= block_size:
+                    flush()
+                    print(f"Encoded {offsets[row + 1]} sentences from {row + 1}/{len(docs)} docs")
+            if block:
+                flush()
+
+        np.save(os.path.join(folder, cls.OFFSETS_FILE), offsets)
+        # The metadata file is written last, its presence marks a complete build
+        with open(os.path.join(folder, cls.META_FILE), "w") as f:
+            json.dump({
+                "ids": [doc["id"] for doc in docs],
+                "dim": dim or 0,
+                "signature": signature or cls.signature(docs),
+            }, f)
+        print(f"Sentence vectors built in {folder}: {int(offsets[-1])} sentences from {len(docs)} docs")
+        return cls(folder)
+
+    @classmethod
+    def load_or_build(cls, folder, docs, encode, **build_args):
+        """Opens the vectors in folder when they were built from the same docs, otherwise rebuilds them."""
+        signature = cls.signature(docs)
+        try:
+            vectors = cls(folder)
+            if vectors.meta.get("signature") == signature:
+                print(f"Sentence vectors loaded from {folder}")
+                return vectors
+        except FileNotFoundError:
+            pass
+        print(f"Encoding the sentences of {len(docs)} docs...")
+        return cls.build(folder, docs, encode, signature=signature, **build_args)
+
+    def get(self, doc_id):
+        """(n_sentences, d) float32 unit vectors of doc_id's sentences, None for docs not in the store."""
+        row = self.row_of.get(doc_id)
+        if row is None:
+            return None
+        return np.asarray(self.vectors[int(self.offsets[row]):int(self.offsets[row + 1])], dtype=np.float32)
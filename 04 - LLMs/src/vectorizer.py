@@ -1,43 +1,156 @@
-from sentence_transformers import SentenceTransformer
 import numpy as np
-import torch
 import os
+import model_registry
+from corpus_encoder import CorpusEncoder
+from embedding_store import EmbeddingStore
+from embedding_cache import EmbeddingCache
+from micro_batcher import MicroBatcher
+
+MODEL_TAGS = {
+    "BAAI/bge-large-en-v1.5": "bge_large",
+    "all-MiniLM-L6-v2": "allMini",
+}
+# Known dimensions, so building the vector store does not load the model (corpus encoding over worker
+# processes loads it only in the workers)
+MODEL_DIMS = {
+    "BAAI/bge-large-en-v1.5": 1024,
+    "all-MiniLM-L6-v2": 384,
+}
 
 class Vectorizer:
-    def __init__(self, model_name="all-MiniLM-L6-v2", device=None):
-        if device is None:
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.device = device
-        self.model = SentenceTransformer(model_name, device=device)
-        print(f"Vectorizer using device: {self.device}")
-
-    def encode_texts(self, texts, batch_size=64):
+    def __init__(self, model_name="all-MiniLM-L6-v2", device=None,
+                 query_cache_size=1024, query_cache_ttl=None, query_cache_path=None, query_cache_disk_size=100_000,
+                 backend="torch", threads=None):
+        # The encoder comes from the shared registry and is only loaded on first use
+        self._device = device
+        self.model_name = model_name
+        # "torch", "onnx" or "onnx-int8" (see onnx_encoder); ONNX exports give the same vectors to cosine ~0.99+
+        self.backend = backend
+        self.threads = threads
+        self.query_cache = None
+        self.encode_batcher = None
+        if query_cache_size:
+            self.query_cache = EmbeddingCache(
+                max_size=query_cache_size, ttl=query_cache_ttl, path=query_cache_path,
+                max_disk_size=query_cache_disk_size
+            )
+
+    @property
+    def device(self):
+        if self.backend != "torch":
+            return "cpu"
+        if self._device is None:
+            self._device = model_registry.default_device()
+            print(f"Vectorizer using device: {self._device}")
+        return self._device
+
+    @property
+    def model(self):
+        return model_registry.get_sentence_transformer(
+            self.model_name, self.device, backend=self.backend, threads=self.threads
+        )
+
+    def warm_up(self):
+        """Loads the encoder and runs one pass so the first real query does not pay for it."""
+        self.model.encode(["warm up"], convert_to_numpy=True)
+
+    def encode_texts(self, texts, batch_size=64, show_progress_bar=True):
         embeddings = self.model.encode(
             texts,
             batch_size=batch_size,
-            show_progress_bar=True,
+            show_progress_bar=show_progress_bar,
             convert_to_numpy=True
         )
         return embeddings.astype(np.float32)
 
-    def compute_vectors_and_metadata(self, texts, docs, dataset_tag, batch_size=64):
-        model_dim = self.model.get_sentence_embedding_dimension()
-        model_name_clean = "bge_large" if model_dim == 1024 else "allMini"
+    def encode_corpus(self, texts, batch_size=64, processes=1, max_tokens=16384, checkpoint_path=None):
+        """Corpus encoding in length-sorted token-budget batches over processes workers (see CorpusEncoder).
+
+        With checkpoint_path an interrupted encode of the same texts resumes instead of starting over."""
+        encoder = CorpusEncoder(
+            self.model_name, self.device, backend=self.backend, threads=self.threads,
+            processes=processes, max_tokens=max_tokens, max_batch=batch_size
+        )
+        return encoder.encode(texts, checkpoint_path=checkpoint_path)
+
+    def count_tokens(self, texts):
+        """Token counts with the encoder's tokenizer, without special tokens."""
+        return [len(ids) for ids in self.model.tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+    def enable_micro_batching(self, max_batch=32, max_wait_ms=5.0):
+        """Shares one encoder call between concurrent encode_queries callers (serving path)."""
+        def encode(batch):
+            return list(self.encode_texts(batch, batch_size=max_batch))
+
+        self.encode_batcher = MicroBatcher(encode, max_batch=max_batch, max_wait_ms=max_wait_ms, name="encode-batcher")
+
+    def _encode_query_texts(self, texts):
+        if self.encode_batcher is None:
+            return self.encode_texts(texts)
+        return np.stack(self.encode_batcher.submit_many(texts))
+
+    def encode_queries(self, texts, instruction=""):
+        """Encodes queries through the query cache; only cache misses reach the model, in one batch."""
+        if self.query_cache is None:
+            return self._encode_query_texts([instruction + text for text in texts])
+
+        keys = [self.query_cache.make_key(self.model_name, text, instruction) for text in texts]
+        vectors = [self.query_cache.get(key) for key in keys]
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = self._encode_query_texts([instruction + texts[i] for i in missing])
+            for i, vector in zip(missing, encoded):
+                self.query_cache.put(keys[i], vector)
+                vectors[i] = vector
+
+        return np.stack(vectors).astype(np.float32, copy=False)
+
+    def get_dimension(self):
+        if self.model_name in MODEL_DIMS:
+            return MODEL_DIMS[self.model_name]
+        return self.model.get_sentence_embedding_dimension()
+
+    def get_model_tag(self):
+        if self.model_name in MODEL_TAGS:
+            return MODEL_TAGS[self.model_name]
+        return "bge_large" if self.get_dimension() == 1024 else "allMini"
+
+    def get_store(self, dataset_tag):
+        model_dim = self.get_dimension()
+        model_name_clean = self.get_model_tag()
 
         BASE_DIR = os.path.dirname(os.path.abspath(__file__))
         CACHE_DIR = os.path.join(BASE_DIR, "cache")
 
         vectors_file = f"{CACHE_DIR}/vectors_{dataset_tag}_{model_name_clean}.npy"
-        
-        try:
-            vectors = np.load(vectors_file)
-            print(f"Vectors loaded from {vectors_file}")
-        except FileNotFoundError:
-            print(f"Computing vectors for {len(texts)} documents...")
-            vectors = self.model.encode(
-                texts, convert_to_numpy=True, batch_size=batch_size, show_progress_bar=True
-            ).astype(np.float32)
-            np.save(vectors_file, vectors)
-            print(f"Vectors computed and saved to {vectors_file}")
-        
-        return vectors, docs
\ No newline at end of file
+        return EmbeddingStore(vectors_file, self.model_name, model_dim)
+
+    def sync_vectors(self, texts, docs, dataset_tag, batch_size=64, mmap=False, processes=1):
+        """Returns (vectors, added_ids, removed_ids), encoding only docs missing from the store.
+
+        With mmap the vectors come back memory-mapped from the cache file instead of loaded into RAM.
+        Missing docs are encoded with encode_corpus, checkpointed next to the cache file until it is saved."""
+        store = self.get_store(dataset_tag)
+        if store.load(legacy_ids=[doc["id"] for doc in docs], legacy_texts=texts, mmap=mmap):
+            print(f"Vectors loaded from {store.vectors_file}")
+
+        checkpoint_path = os.path.splitext(store.vectors_file)[0] + ".encoding"
+
+        def encode(batch):
+            return self.encode_corpus(batch, batch_size=batch_size, processes=processes, checkpoint_path=checkpoint_path)
+
+        vectors, added_ids, removed_ids = store.sync(docs, texts, encode)
+        CorpusEncoder.remove_checkpoint(checkpoint_path)
+        if mmap and (added_ids or removed_ids):
+            # sync rebuilt the matrix in RAM to save it, map the saved file again
+            vectors = np.load(store.vectors_file, mmap_mode="r")
+        return vectors, added_ids, removed_ids
+
+    def compute_vectors_and_metadata(self, texts, docs, dataset_tag, batch_size=64, storage="float32", processes=1):
+        """storage is the FAISSIndex storage the vectors are meant for. Compact ones only need the full-precision
+        vectors to rescore a few candidates per query, so the cache file is memory-mapped instead of loaded."""
+        vectors, _, _ = self.sync_vectors(
+            texts, docs, dataset_tag, batch_size=batch_size, mmap=storage != "float32", processes=processes
+        )
+        return vectors, docs
@@ -1,3 +1,5 @@
+import threading
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from routes import Routes
 from fastapi.staticfiles import StaticFiles
@@ -5,8 +7,17 @@ from fastapi.responses import FileResponse
 from pathlib import Path
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
-app.include_router(Routes().router)
+routes = Routes()
+
+@asynccontextmanager
+async def lifespan(app):
+    # Warm up in the background: the server accepts connections right away and /ready reports progress
+    if routes.warm_up_on_start:
+        threading.Thread(target=routes.warm_up, name="warm-up", daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(routes.router)
 
 app.add_middleware(
         CORSMiddleware,
@@ -0,0 +1,74 @@
+import asyncio
+
+
+class Overloaded(Exception):
+    pass
+
+
+class RequestLimiter:
+    """Caps concurrent requests, bounds how many may wait for a slot and applies a per-request timeout."""
+
+    def __init__(self, max_concurrency=8, max_queue=64, timeout=60.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    async def acquire(self):
+        """Takes a slot, waiting at most timeout seconds; raises Overloaded when the wait queue is full."""
+        if not self._semaphore.locked():
+            # A slot is free, acquire returns without waiting
+            await self._semaphore.acquire()
+        else:
+            # Reject right away instead of queueing without limit
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded(f"{self.waiting} requests already waiting")
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise
+            finally:
+                self.waiting -= 1
+        self.active += 1
+
+    def release(self, completed=True):
+        self.active -= 1
+        if completed:
+            self.completed += 1
+        self._semaphore.release()
+
+    async def run(self, coro_fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+
+        await self.acquire()
+        completed = False
+        try:
+            result = await asyncio.wait_for(coro_fn(*args, **kwargs), timeout=max(deadline - loop.time(), 0))
+            completed = True
+            return result
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.release(completed)
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
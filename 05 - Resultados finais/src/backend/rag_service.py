@@ -1,47 +1,231 @@
-import numpy as np
+import asyncio
 import sys
 import os
-import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 module_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../04 - LLMs/src"))
 sys.path.append(module_path)
 
-from pathlib import Path
 from vectorizer import Vectorizer
-from faiss_index import FAISSIndex
 from rag import PatentsRAG
-from data_handler import DataHandler
-from google import genai
 from llm import LLM
+from answer_cache import AnswerCache
+from reranker import Reranker
+from index_bundle import bundles_dir_for, current_version, open_bundle, open_sentence_vectors, open_sparse_index
 from dotenv import load_dotenv
 
 
-ROOT = Path(__file__).resolve().parents[3]  
-DATA_PATH = ROOT / "data"
-
 class RAGService:
-    def __init__(self, USE_SAMPLE):
+    def __init__(self, USE_SAMPLE, llm_client=None, answer_cache=None, cpu_workers=None):
         load_dotenv() 
         # self.model_name = "BAAI/bge-large-en-v1.5"
         self.model_name = "all-MiniLM-L6-v2"
-        self.vectorizer = Vectorizer(model_name=self.model_name)
-        dataset_tag = "sample" if USE_SAMPLE else "2016"
-        self.data_handler = DataHandler(DATA_PATH)
+        # Encoder backend per deployment: ENCODER_BACKEND=torch|onnx|onnx-int8, ENCODER_THREADS caps CPU threads
+        encoder_threads = os.getenv("ENCODER_THREADS")
+        self.vectorizer = Vectorizer(
+            model_name=self.model_name,
+            backend=os.getenv("ENCODER_BACKEND", "torch"),
+            threads=int(encoder_threads) if encoder_threads else None
+        )
+        self.dataset_tag = "sample" if USE_SAMPLE else "2016"
+        self.bundles_dir = bundles_dir_for(
+            os.path.join(module_path, "cache"), self.dataset_tag, self.vectorizer.get_model_tag()
+        )
+
+        # The server only opens bundles; building one is the offline job of index_bundle.py. Building here
+        # would have every worker write its own bundle at once.
+        if current_version(self.bundles_dir) is None:
+            raise FileNotFoundError(
+                f"No index bundle published in {self.bundles_dir}: run `make build-index DATASET_TAG={self.dataset_tag}` first"
+            )
+
+        # Concurrent requests share encoder passes and index searches instead of running batch-size-1 calls
+        self.retrieval_mode = os.getenv("RETRIEVAL_MODE", "dense")
+        # Prompt sentences are packed by cosine with the query ("dense") or by BM25 ("lexical")
+        self.context_scoring = os.getenv("CONTEXT_SCORING", "dense")
+        # Cross-encoder rerank stage, off unless RERANK_MODEL is set
+        rerank_model = os.getenv("RERANK_MODEL")
+        self.reranker = Reranker(
+            rerank_model,
+            candidates=int(os.getenv("RERANK_CANDIDATES", "20")),
+            time_budget_ms=float(os.getenv("RERANK_BUDGET_MS", "300"))
+        ) if rerank_model else None
+        self.micro_batch_max = int(os.getenv("MICRO_BATCH_MAX", "32"))
+        self.micro_batch_wait_ms = float(os.getenv("MICRO_BATCH_WAIT_MS", "5"))
+        if self.micro_batch_max > 1:
+            self.vectorizer.enable_micro_batching(max_batch=self.micro_batch_max, max_wait_ms=self.micro_batch_wait_ms)
+
+        # llm_client lets a local stub stand in for the genai client
+        if llm_client is None:
+            from google import genai
+            llm_client = genai.Client(api_key= os.getenv("API_KEY"))
+        self.llm = LLM(client=llm_client, model="gemini-2.5-flash")
+        self.answer_cache = answer_cache if answer_cache is not None else AnswerCache(similarity_threshold=0.95)
+        # Encode + search is CPU bound: run it on its own pool sized to the cores, off the event loop
+        self.cpu_executor = ThreadPoolExecutor(
+            max_workers=cpu_workers or os.cpu_count() or 1,
+            thread_name_prefix="rag-cpu"
+        )
+
+        self.rag = None
+        self.bundle_version = None
+        self._reload_lock = threading.Lock()
+        # Requests in flight per PatentsRAG; a replaced one is released when its last request finishes
+        self._leases = {}
+        self._retired = set()
+        self._lease_lock = threading.Lock()
+        self.reload()
+
+    def reload(self, verify=False):
+        """Swaps in the published bundle if it changed. Returns True when a new version was loaded.
+
+        The new index is fully opened before self.rag is replaced, so requests already running keep the
+        PatentsRAG (and index) they started with. The old index is closed once the last of them is done.
+        """
+        with self._reload_lock:
+            version = current_version(self.bundles_dir)
+            if version is None or version == self.bundle_version:
+                return False
+
+            faiss_index, manifest = open_bundle(
+                self.bundles_dir, version, model_name=self.model_name, verify=verify
+            )
+            if self.micro_batch_max > 1:
+                faiss_index.enable_micro_batching(max_batch=self.micro_batch_max, max_wait_ms=self.micro_batch_wait_ms)
 
-        texts, docs = self.data_handler.load_texts(
-            dataset_tag=dataset_tag,
-            ner_model_name=self.data_handler.get_ner_model_name()
+            retrieval_mode = self.retrieval_mode
+            if retrieval_mode == "chunks":
+                # Bundles hold no chunk index, it needs the full descriptions of the raw patent files
+                print(f"Bundles do not include a chunk index, serving dense retrieval instead of {retrieval_mode}")
+                retrieval_mode = "dense"
+            sparse_index = open_sparse_index(self.bundles_dir, version) if retrieval_mode != "dense" else None
+            if retrieval_mode != "dense" and sparse_index is None:
+                print(f"Bundle {version} has no BM25 index, serving dense retrieval")
+                retrieval_mode = "dense"
+
+            sentence_vectors = None
+            if self.context_scoring == "dense":
+                sentence_vectors = open_sentence_vectors(self.bundles_dir, version)
+                if sentence_vectors is None:
+                    print(f"Bundle {version} has no sentence vectors, packing prompts lexically")
+
+            rag = PatentsRAG(
+                faiss_index, self.vectorizer, score_threshold=0.1,
+                sparse_index=sparse_index, retrieval_mode=retrieval_mode, reranker=self.reranker,
+                sentence_vectors=sentence_vectors, context_scoring=self.context_scoring
+            )
+            with self._lease_lock:
+                old_rag, self.rag = self.rag, rag
+                if old_rag is not None and old_rag in self._leases:
+                    self._retired.add(old_rag)
+                    old_rag = None
+            if old_rag is not None:
+                old_rag.index.close()
+            self.faiss_index = faiss_index
+            self.docs = faiss_index.docs
+            self.bundle_manifest = manifest
+            self.bundle_version = version
+            # Cached answers cite patents of the previous version
+            self.answer_cache.invalidate()
+            print(f"Serving bundle {version} ({manifest['count']} docs)")
+            return True
+
+    def watch_bundles(self, interval=30.0):
+        """Polls CURRENT in a daemon thread and hot-swaps newly published bundles."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    print(f"Bundle reload failed, keeping {self.bundle_version}: {e}")
+
+        threading.Thread(target=loop, name="bundle-watcher", daemon=True).start()
+
+    def warm_up(self):
+        """Loads the encoder (and torch) before the first request arrives."""
+        self.vectorizer.warm_up()
+        if self.reranker is not None:
+            self.reranker.warm_up()
+
+    @contextmanager
+    def _lease(self):
+        """The current PatentsRAG, kept open until the block exits even if a reload replaces it meanwhile."""
+        with self._lease_lock:
+            rag = self.rag
+            self._leases[rag] = self._leases.get(rag, 0) + 1
+        try:
+            yield rag
+        finally:
+            with self._lease_lock:
+                self._leases[rag] -= 1
+                release = self._leases[rag] == 0 and rag in self._retired
+                if self._leases[rag] == 0:
+                    del self._leases[rag]
+                    self._retired.discard(rag)
+            if release:
+                rag.index.close()
+
+    def retrieve(self, query: str, top_k: int = 3, filters: dict = None, min_score: float = None, offset: int = 0):
+        """top_k nearest patents, or with min_score every patent over it, top_k per page starting at offset."""
+        with self._lease() as rag:
+            if min_score is None:
+                return rag.retrieve(query, top_k, self.model_name, filters)
+            return rag.retrieve_range(query, self.model_name, min_score, max_results=top_k, offset=offset,
+                                      filters=filters)
+
+    def ask(self, query: str, top_k: int = 3, filters: dict = None, min_score: float = None, offset: int = 0) -> str:
+        result = self.retrieve(query, top_k, filters, min_score, offset)
+        if not result.has_evidence:
+            return result.prompt
+
+        answer = self.answer_cache.get(result.prompt, result.query_vec, result.ids)
+        if answer is None:
+            answer = self.llm.generate_text(result.prompt)
+            self.answer_cache.put(result.prompt, answer, result.query_vec, result.ids)
+        return answer
+
+    async def ask_async(self, query: str, top_k: int = 3, filters: dict = None, min_score: float = None,
+                        offset: int = 0) -> str:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            self.cpu_executor, self.retrieve, query, top_k, filters, min_score, offset
         )
+        if not result.has_evidence:
+            return result.prompt
+
+        answer = self.answer_cache.get(result.prompt, result.query_vec, result.ids)
+        if answer is None:
+            answer = await self.llm.generate_text_async(result.prompt)
+            self.answer_cache.put(result.prompt, answer, result.query_vec, result.ids)
+        return answer
 
-        self.vectors, self.docs = self.vectorizer.compute_vectors_and_metadata(
-            texts, docs, dataset_tag,
-            batch_size=64
+    async def ask_stream(self, query: str, top_k: int = 3, filters: dict = None, min_score: float = None,
+                         offset: int = 0):
+        """Yields the answer in chunks as the LLM produces them; closing the generator stops the LLM stream."""
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            self.cpu_executor, self.retrieve, query, top_k, filters, min_score, offset
         )
+        if not result.has_evidence:
+            yield result.prompt
+            return
 
-        self.faiss_index = FAISSIndex(self.vectors, docs)
-        self.rag = PatentsRAG(self.faiss_index, self.vectorizer, score_threshold=0.1)
-        self.llm = LLM(client=genai.Client(api_key= os.getenv("API_KEY")), model="gemini-2.5-flash")
+        answer = self.answer_cache.get(result.prompt, result.query_vec, result.ids)
+        if answer is not None:
+            yield answer
+            return
 
-    def ask(self, query: str, top_k: int = 3) -> str:
-        prompt, _ = self.rag.generate_prompt(query, top_k, self.model_name)
-        return self.llm.generate_text(prompt)
\ No newline at end of file
+        chunks = []
+        stream = self.llm.generate_stream_async(result.prompt)
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await stream.aclose()
+        # Only reached when the stream completed, partial answers are never cached
+        self.answer_cache.put(result.prompt, "".join(chunks), result.query_vec, result.ids)
@@ -1,17 +1,163 @@
-from fastapi import APIRouter
+import asyncio
+import json
+import os
+import threading
+from typing import List, Literal, Optional
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from rag_service import RAGService
+from limiter import RequestLimiter, Overloaded
+import model_registry
 
 class Routes:
     def __init__(self):
         self.router = APIRouter()
-        self.rag = RAGService(False)
+        # RAGService is built on first use or by warm_up(), never at import time
+        self._rag = None
+        self._rag_lock = threading.Lock()
+        # With warm-up (WARM_UP=0 disables it), /ready waits for the encoder, not just for the service
+        self.warm_up_on_start = os.getenv("WARM_UP", "1") != "0"
+        self._ready = False
+        self.limiter = RequestLimiter(
+            max_concurrency=int(os.getenv("MAX_CONCURRENCY", "8")),
+            max_queue=int(os.getenv("MAX_QUEUE", "64")),
+            timeout=float(os.getenv("REQUEST_TIMEOUT", "60"))
+        )
 
         @self.router.post("/message")
-        def ask_route(req: Query):
-            answer = self.rag.ask(req.query, req.top_k)
+        async def ask_route(req: Query):
+            try:
+                rag = await self.get_rag()
+                answer = await self.limiter.run(rag.ask_async, req.query, req.top_k, req.filter_dict(), req.min_score, req.offset)
+            except Overloaded:
+                raise HTTPException(status_code=503, detail="Server busy, try again later", headers={"Retry-After": "1"})
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail="Request timed out")
             return {"answer": answer}
 
+        @self.router.post("/message/stream")
+        async def ask_stream_route(req: Query, request: Request):
+            rag = await self.get_rag()
+            loop = asyncio.get_running_loop()
+            # Same total budget as /message: queueing and the whole stream must fit in REQUEST_TIMEOUT
+            deadline = loop.time() + self.limiter.timeout
+            # Admission happens before the response starts, so a full queue still gets a 503
+            try:
+                await self.limiter.acquire()
+            except Overloaded:
+                raise HTTPException(status_code=503, detail="Server busy, try again later", headers={"Retry-After": "1"})
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail="Request timed out")
+
+            released = False
+
+            def release(completed=False):
+                nonlocal released
+                if not released:
+                    released = True
+                    self.limiter.release(completed)
+
+            async def events():
+                completed = False
+                chunks = rag.ask_stream(req.query, req.top_k, req.filter_dict(), req.min_score, req.offset)
+                try:
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(deadline - loop.time(), 0))
+                        except StopAsyncIteration:
+                            completed = True
+                            yield "event: done\ndata: {}\n\n"
+                            break
+                        except asyncio.TimeoutError:
+                            self.limiter.timeouts += 1
+                            yield f"event: error\ndata: {json.dumps({'detail': 'Request timed out'})}\n\n"
+                            break
+                        if await request.is_disconnected():
+                            break
+                        yield f"data: {json.dumps({'text': chunk})}\n\n"
+                finally:
+                    # Stops the upstream LLM stream when the client went away or the deadline passed
+                    await chunks.aclose()
+                    release(completed)
+
+            # The background task frees the slot when the client left before the body was ever iterated,
+            # the generator's finally never runs then; after a started stream it is a no-op
+            return StreamingResponse(
+                events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"},
+                background=BackgroundTask(release)
+            )
+
+        @self.router.get("/ready")
+        def ready_route():
+            ready = self._ready if self.warm_up_on_start else self._rag is not None
+            body = {
+                "ready": ready,
+                "models": model_registry.loaded_models(),
+                "bundle_version": self._rag.bundle_version if self._rag is not None else None,
+            }
+            if not ready:
+                raise HTTPException(status_code=503, detail=body)
+            return body
+
+        @self.router.post("/admin/reload")
+        async def reload_route():
+            rag = await self.get_rag()
+            try:
+                reloaded = await asyncio.to_thread(rag.reload, True)
+            except ValueError as e:
+                raise HTTPException(status_code=409, detail=str(e))
+            return {"reloaded": reloaded, "bundle_version": rag.bundle_version}
+
+        @self.router.get("/stats")
+        def stats_route():
+            rag = self._rag
+            if rag is None:
+                return {"requests": self.limiter.stats()}
+            return {
+                "requests": self.limiter.stats(),
+                "answer_cache": rag.answer_cache.stats(),
+                "query_cache": rag.vectorizer.query_cache.stats() if rag.vectorizer.query_cache else None,
+                "encode_batching": rag.vectorizer.encode_batcher.stats() if rag.vectorizer.encode_batcher else None,
+                "search_batching": rag.faiss_index.search_batcher.stats() if rag.faiss_index.search_batcher else None,
+                "rerank": rag.reranker.stats() if rag.reranker else None,
+            }
+
+    def _load_rag(self):
+        with self._rag_lock:
+            if self._rag is None:
+                rag = RAGService(False)
+                poll_seconds = float(os.getenv("BUNDLE_POLL_SECONDS", "30"))
+                if poll_seconds > 0:
+                    rag.watch_bundles(poll_seconds)
+                self._rag = rag
+            return self._rag
+
+    async def get_rag(self):
+        if self._rag is not None:
+            return self._rag
+        # Building the service blocks, keep it off the event loop
+        return await asyncio.to_thread(self._load_rag)
+
+    def warm_up(self):
+        """Builds the service and loads the encoder; /ready turns 200 once both are done."""
+        self._load_rag().warm_up()
+        self._ready = True
+
+class Filters(BaseModel):
+    cpc: List[str] = []
+    date_from: Optional[str] = None
+    date_to: Optional[str] = None
+    date_field: Literal["filing_date", "patent_issue_date"] = "filing_date"
+
 class Query(BaseModel):
     query: str
-    top_k: int = 3
\ No newline at end of file
+    top_k: int = 3
+    filters: Optional[Filters] = None
+    # With min_score every patent over it is eligible, top_k per page starting at offset
+    min_score: Optional[float] = None
+    offset: int = 0
+
+    def filter_dict(self):
+        return self.filters.model_dump() if self.filters is not None else None
@@ -14,7 +14,7 @@ function App() {
     setMessages((prev) => [...prev, `You: ${text}`]);
     setIsLoading(true);
 
-    const res = await fetch("/message", {
+    const res = await fetch("/message/stream", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({
@@ -23,10 +23,46 @@ function App() {
         }),
     });
 
-    const data = await res.json();
-    console.log("data: ", data)
+    if (!res.ok) {
+      setMessages((prev) => [...prev, `LLM: Error ${res.status}, please try again.`]);
+      setIsLoading(false);
+      return;
+    }
+
+    // Server-sent events: show the answer as chunks arrive instead of waiting for the full completion
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let answer = "";
+    let started = false;
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      const events = buffer.split("\n\n");
+      buffer = events.pop();
+      for (const event of events) {
+        const data = event.split("\n").find((line) => line.startsWith("data: "));
+        if (event.startsWith("event: error")) {
+          setMessages((prev) => [...prev, `LLM: ${JSON.parse(data.slice(6)).detail}, please try again.`]);
+          continue;
+        }
+        if (!data || event.startsWith("event: done")) continue;
+        answer += JSON.parse(data.slice(6)).text;
+        const current = answer;
+
+        if (!started) {
+          started = true;
+          setIsLoading(false);
+          setMessages((prev) => [...prev, `LLM: ${current}`]);
+        } else {
+          setMessages((prev) => [...prev.slice(0, -1), `LLM: ${current}`]);
+        }
+      }
+    }
 
-    setMessages((prev) => [...prev, `LLM: ${data.answer}`]);
     setIsLoading(false);
   }
 